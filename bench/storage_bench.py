@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#Canto - RSS reader backend
+#   Copyright (C) 2010 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Storage micro-benchmarks. This generates synthetic feedparser-shaped feeds,
+# loads them into a temporary conf dir, and times the storage heavy
+# operations the daemon performs, printing the results as JSON so runs can be
+# compared across commits. Nothing here touches the network.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+
+from canto_next.storage import CantoShelf, CantoSQLiteShelf
+from canto_next.feed import CantoFeed, allfeeds
+from canto_next.fetch import CantoFetch
+from canto_next.hooks import call_hook
+from canto_next.tag import alltags
+from canto_next.transform import StateFilter, SortTransform
+
+from feedparser import FeedParserDict
+import subprocess
+import tempfile
+import resource
+import logging
+import getopt
+import random
+import shutil
+import json
+import time
+
+log = logging.getLogger("BENCH")
+
+def usage():
+    print("USAGE: storage_bench.py [options]")
+    print("\t-f/--feeds [n]\t\tNumber of feeds (default: 20)")
+    print("\t-i/--items [n]\t\tItems per feed (default: 200)")
+    print("\t-s/--payload [bytes]\tSize of each item's content (default: 2048)")
+    print("\t-n/--iterations [n]\tRepetitions of each operation (default: 200)")
+    print("\t-b/--batch [n]\t\tItems per attribute request (default: 50)")
+    print("\t--storage [engine]\tshelve or sqlite (default: shelve)")
+    print("\t--codec [codec]\t\tStorage codec (default: marshal)")
+    print("\t--compress [type]\tStorage compression (default: none)")
+    print("\t-D/--dir [directory]\tConf dir to use (default: temporary)")
+    print("\t-o/--output [file]\tWrite JSON here instead of stdout")
+    print("\t--seed [n]\t\tRandom seed (default: 0)")
+
+class Settings():
+    def __init__(self):
+        self.feeds = 20
+        self.items = 200
+        self.payload = 2048
+        self.iterations = 200
+        self.batch = 50
+        self.storage = "shelve"
+        self.codec = "marshal"
+        self.compression = "none"
+        self.conf_dir = None
+        self.output = None
+        self.seed = 0
+
+    def args(self):
+        try:
+            optlist = getopt.getopt(sys.argv[1:], 'f:i:s:n:b:D:o:h',\
+                    ["feeds=", "items=", "payload=", "iterations=", "batch=",
+                     "storage=", "codec=", "compress=", "dir=", "output=",
+                     "seed=", "help"])[0]
+        except getopt.GetoptError as e:
+            log.error("Error: %s" % e.msg)
+            return -1
+
+        ints = { "-f" : "feeds", "--feeds" : "feeds",
+                 "-i" : "items", "--items" : "items",
+                 "-s" : "payload", "--payload" : "payload",
+                 "-n" : "iterations", "--iterations" : "iterations",
+                 "-b" : "batch", "--batch" : "batch",
+                 "--seed" : "seed" }
+
+        for opt, arg in optlist:
+            if opt in ints:
+                try:
+                    setattr(self, ints[opt], int(arg))
+                except:
+                    log.error("Error: %s must be an integer." % opt)
+                    return -1
+            elif opt in ["--storage"]:
+                self.storage = arg
+            elif opt in ["--codec"]:
+                self.codec = arg
+            elif opt in ["--compress"]:
+                self.compression = arg
+            elif opt in ["-D", "--dir"]:
+                self.conf_dir = os.path.realpath(os.path.expanduser(arg))
+            elif opt in ["-o", "--output"]:
+                self.output = arg
+            elif opt in ["-h", "--help"]:
+                usage()
+                return 1
+        return 0
+
+# Build something that looks like it came out of feedparser.parse(), complete
+# with the redundant *_detail dicts and links lists.
+
+def make_entry(rand, URL, idx, payload):
+    link = "%s/story/%d" % (URL, idx)
+    title = "Story %d %x" % (idx, rand.getrandbits(32))
+    body = "".join([ rand.choice("abcdefghij klmnop") for x in range(payload) ])
+    summary = body[:payload // 4]
+
+    e = FeedParserDict()
+    e["id"] = link
+    e["guidislink"] = False
+    e["link"] = link
+    e["links"] = [ FeedParserDict({ "rel" : "alternate",
+        "type" : "text/html", "href" : link }) ]
+    e["title"] = title
+    e["title_detail"] = FeedParserDict({ "type" : "text/plain",
+        "language" : None, "base" : URL, "value" : title })
+    e["summary"] = summary
+    e["summary_detail"] = FeedParserDict({ "type" : "text/html",
+        "language" : None, "base" : URL, "value" : summary })
+    e["content"] = [ FeedParserDict({ "type" : "text/html",
+        "language" : None, "base" : URL, "value" : body }) ]
+    e["author"] = "author%d" % (idx % 7)
+    e["published"] = time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+            time.gmtime(1300000000 + idx * 60))
+    e["published_parsed"] = time.gmtime(1300000000 + idx * 60)
+    return e
+
+def make_feed(rand, URL, items, payload, first = 0):
+    d = FeedParserDict()
+    d["feed"] = FeedParserDict({ "title" : URL, "link" : URL,
+        "subtitle" : "Synthetic feed" })
+    d["entries"] = [ make_entry(rand, URL, first + i, payload)\
+            for i in range(items) ]
+    d["bozo"] = 0
+    d["encoding"] = "utf-8"
+    d["version"] = "rss20"
+    d["status"] = 200
+    d["href"] = URL
+    d["canto_update"] = time.time()
+    return d
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    idx = int(round((p / 100.0) * (len(sorted_samples) - 1)))
+    return sorted_samples[idx]
+
+# Time func() iterations times, with setup() (if any) run untimed before each.
+
+def measure(name, iterations, func, setup = None):
+    samples = []
+    for i in range(iterations):
+        arg = None
+        if setup:
+            arg = setup(i)
+
+        start = time.perf_counter()
+        func(arg)
+        samples.append(time.perf_counter() - start)
+
+        # Let the shelf do its periodic work, like the daemon would.
+        call_hook("work_done", [])
+
+    samples.sort()
+    total = sum(samples)
+
+    r = { "iterations" : iterations,
+          "total" : total,
+          "ops_per_sec" : iterations / total if total else 0.0,
+          "p50" : percentile(samples, 50),
+          "p90" : percentile(samples, 90),
+          "p99" : percentile(samples, 99),
+          "max" : samples[-1] if samples else 0.0,
+          "peak_rss" : peak_rss() }
+
+    log.info("%s: p50 %fs p99 %fs (%d ops/sec)" %\
+            (name, r["p50"], r["p99"], r["ops_per_sec"]))
+    return r
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd = os.path.dirname(os.path.abspath(__file__)),
+                stderr = subprocess.DEVNULL).decode().strip()
+    except:
+        return None
+
+def run(settings):
+    rand = random.Random(settings.seed)
+
+    if settings.storage == "sqlite":
+        shelf = CantoSQLiteShelf(settings.conf_dir + "/feeds.sqlite", True,
+                codec = settings.codec, compression = settings.compression)
+    else:
+        shelf = CantoShelf(settings.conf_dir + "/feeds", True,
+                codec = settings.codec, compression = settings.compression)
+
+    fetch = CantoFetch(shelf)
+
+    feeds = []
+    setup_start = time.time()
+    for i in range(settings.feeds):
+        URL = "http://bench.invalid/feed%d" % i
+        feed = CantoFeed(shelf, "Feed %d" % i, URL, 10, 86400, False)
+        feed.update_contents = make_feed(rand, URL, settings.items,
+                settings.payload)
+        feed.index()
+        feeds.append(feed)
+    shelf.flush()
+
+    results = {}
+    results["setup_time"] = time.time() - setup_start
+
+    def random_feed(i):
+        return feeds[rand.randrange(len(feeds))]
+
+    def random_batch(i):
+        feed = random_feed(i)
+        items = [ x.handle for x in\
+                rand.sample(feed.items, min(settings.batch, len(feed.items))) ]
+        return (feed, items)
+
+    # Raw storage access, first through the cache, then around it.
+
+    results["shelf_get"] = measure("shelf_get", settings.iterations,
+            lambda feed : shelf[feed.URL], random_feed)
+
+    def uncached(i):
+        feed = random_feed(i)
+        shelf.cache.invalidate(feed.URL)
+        return feed
+
+    results["shelf_get_uncached"] = measure("shelf_get_uncached",
+            settings.iterations, lambda feed : shelf[feed.URL], uncached)
+
+    def shelf_set(feed):
+        shelf[feed.URL] = shelf[feed.URL]
+
+    results["shelf_set"] = measure("shelf_set", settings.iterations,
+            shelf_set, random_feed)
+
+    # Re-indexing, half of each fetch is new content.
+
+    def fresh_content(i):
+        feed = random_feed(i)
+        feed.update_contents = make_feed(rand, feed.URL, settings.items,
+                settings.payload, (i + 1) * (settings.items // 2))
+        return feed
+
+    results["index"] = measure("index", max(1, settings.iterations // 10),
+            lambda feed : feed.index(), fresh_content)
+
+    attrs = [ "title", "link", "description", "canto-state" ]
+
+    def get_attributes(args):
+        feed, items = args
+        feed.get_attributes(items, dict([ (i, attrs) for i in items ]))
+
+    results["get_attributes"] = measure("get_attributes",
+            settings.iterations, get_attributes, random_batch)
+
+    # Filtering and sorting a feed's tag, like a client would.
+
+    state_filter = StateFilter("read")
+    sort = SortTransform("Sort Alphabetical", "title")
+
+    def transform(feed):
+        tag = [ i.handle for i in feed.items ]
+        sort(state_filter(tag, lambda i : False), lambda i : False)
+
+    results["transform"] = measure("transform", settings.iterations,
+            transform, random_feed)
+
+    def set_attributes(args):
+        feed, items = args
+        feed.set_attributes(items,\
+                dict([ (i, { "canto-state" : [ "read" ] }) for i in items ]))
+
+    results["set_attributes"] = measure("set_attributes",
+            settings.iterations, set_attributes, random_batch)
+
+    results["next_due"] = measure("next_due", settings.iterations,
+            lambda feed : fetch.next_due(feed), random_feed)
+
+    # The main loop's check for due feeds, between refreshes.
+
+    fetch.reschedule()
+    results["fetch_check"] = measure("fetch_check", settings.iterations,
+            lambda feed : fetch.fetch(False), random_feed)
+
+    # Daemon startup, setting up every feed from disk, with and without lazy
+    # loading.
+
+    def startup(lazy):
+        allfeeds.reset()
+        alltags.reset()
+        for i, feed in enumerate(feeds):
+            CantoFeed(shelf, feed.name, feed.URL, 10, 86400, False,
+                    lazy = lazy)
+
+    def cold_startup(i):
+        shelf.flush()
+        shelf.cache.clear()
+
+    results["startup"] = measure("startup", max(1, settings.iterations // 10),
+            lambda arg : startup(False), cold_startup)
+
+    results["startup_lazy"] = measure("startup_lazy",
+            max(1, settings.iterations // 10), lambda arg : startup(True),
+            cold_startup)
+
+    shelf.flush()
+    results["db_bytes"] = shelf._db_size()
+    results["storage_stats"] = shelf.stats()
+
+    call_hook("exit", [])
+    return results
+
+def main():
+    logging.basicConfig(
+            format = "%(asctime)s : %(name)s -> %(message)s",
+            datefmt = "%H:%M:%S",
+            level = logging.INFO
+    )
+
+    settings = Settings()
+    r = settings.args()
+    if r:
+        sys.exit(max(r, 0))
+
+    tmpdir = None
+    if not settings.conf_dir:
+        tmpdir = tempfile.mkdtemp(prefix = "canto-bench-")
+        settings.conf_dir = tmpdir
+    elif not os.path.exists(settings.conf_dir):
+        os.makedirs(settings.conf_dir)
+
+    # Keep the daemon's own chatter out of the results.
+    for name in [ "FEED", "SHELF", "TAG", "PROTECT", "CANTO-FETCH" ]:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    try:
+        results = run(settings)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+    out = { "revision" : git_revision(),
+            "python" : sys.version.split()[0],
+            "time" : time.time(),
+            "settings" : { "feeds" : settings.feeds,
+                           "items" : settings.items,
+                           "payload" : settings.payload,
+                           "iterations" : settings.iterations,
+                           "batch" : settings.batch,
+                           "storage" : settings.storage,
+                           "codec" : settings.codec,
+                           "compression" : settings.compression,
+                           "seed" : settings.seed },
+            "results" : results }
+
+    if settings.output:
+        f = open(settings.output, "w")
+        json.dump(out, f, indent = 4, sort_keys = True)
+        f.close()
+    else:
+        print(json.dumps(out, indent = 4, sort_keys = True))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2010 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# A small HTTP/1.1 client on asyncio, for fetching lots of feeds from a handful
+# of hosts. It keeps idle connections to each host open so that they can be
+# reused, rather than paying for a new TCP (and TLS) connection every fetch.
+
+# It only does what fetching feeds needs: GET, redirects, gzip/deflate, chunked
+# responses, basic auth, a timeout and a cap on the size of the body.
+
+from threading import Thread
+import urllib.parse
+import asyncio
+import logging
+import base64
+import time
+import ssl
+import zlib
+
+log = logging.getLogger("ASYNCFETCH")
+
+MAX_REDIRECTS = 5
+
+# Idle connections older than this are closed instead of reused, since the
+# server has probably given up on them.
+
+IDLE_TIMEOUT = 30
+
+class FetchError(Exception):
+    pass
+
+class CantoHTTPError(FetchError):
+    def __init__(self, URL, status):
+        FetchError.__init__(self, "HTTP %d from %s" % (status, URL))
+        self.status = status
+
+# Undo any gzip or deflate Content-Encoding. The decompressed size is limited
+# too, or a small response could still balloon past max_size.
+
+def decompress(headers, body, max_size):
+    encoding = headers.get("content-encoding", "")
+    if "gzip" in encoding:
+        wbits = 16 + zlib.MAX_WBITS
+    elif "deflate" in encoding:
+        wbits = zlib.MAX_WBITS
+        if body[:1] and (body[0] & 0x0f) != 8:
+            # Some servers send raw deflate, without the zlib header.
+            wbits = -zlib.MAX_WBITS
+    else:
+        return body
+
+    d = zlib.decompressobj(wbits)
+    out = d.decompress(body, max_size + 1)
+    if len(out) > max_size:
+        raise FetchError("Body too large")
+    return out
+
+class CantoConnection():
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.used = time.time()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+class CantoAsyncFetch():
+    def __init__(self, timeout = 60, max_size = 8 * 1024 * 1024,
+            max_idle = 4):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.max_idle = max_idle
+
+        self.loop = None
+        self.thread = None
+
+        # { (scheme, host, port) : [ idle CantoConnection, ... ] }
+        self.idle = {}
+
+        self.connections = 0
+        self.reused = 0
+        self.requests = 0
+
+    def configure(self, timeout, max_size):
+        self.timeout = timeout
+        self.max_size = max_size
+
+    # Run the event loop in a thread of its own, so fetch threads can use it
+    # through download().
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target = self.loop.run_forever, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        def close():
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(close)
+        self.thread.join()
+        self.loop.close()
+        self.thread = None
+        self.loop = None
+
+    # Blocking version of get(), for use from other threads.
+
+    def download(self, URL, headers, username = None, password = None):
+        future = asyncio.run_coroutine_threadsafe(\
+                self.get(URL, headers, username, password), self.loop)
+        return future.result()
+
+    # Fetch URL, following redirects. Return (status, { lowercase header :
+    # value }, decompressed body, final URL). A 304 is returned with an empty
+    # body, other errors raise FetchError.
+
+    async def get(self, URL, headers, username = None, password = None):
+        headers = dict(headers)
+        if username or password:
+            creds = "%s:%s" % (username or "", password or "")
+            headers["Authorization"] = "Basic " +\
+                    base64.b64encode(creds.encode("UTF-8")).decode("ascii")
+
+        for i in range(MAX_REDIRECTS + 1):
+            status, rheaders, body = await asyncio.wait_for(\
+                    self.request(URL, headers), self.timeout)
+
+            if status in [ 301, 302, 303, 307, 308 ] and\
+                    "location" in rheaders:
+                newURL = urllib.parse.urljoin(URL, rheaders["location"])
+
+                # Don't hand credentials to some other host.
+
+                if urllib.parse.urlparse(newURL)[1] !=\
+                        urllib.parse.urlparse(URL)[1] and\
+                        "Authorization" in headers:
+                    del headers["Authorization"]
+
+                log.debug("%s redirected to %s" % (URL, newURL))
+                URL = newURL
+                continue
+
+            if status == 304:
+                return (status, rheaders, b"", URL)
+
+            if status >= 400:
+                raise CantoHTTPError(URL, status)
+
+            return (status, rheaders,\
+                    decompress(rheaders, body, self.max_size), URL)
+
+        raise FetchError("Too many redirects from %s" % URL)
+
+    async def connect(self, key):
+        scheme, host, port = key
+
+        conns = self.idle.get(key, [])
+        while conns:
+            conn = conns.pop()
+            if time.time() - conn.used < IDLE_TIMEOUT and\
+                    not conn.reader.at_eof():
+                self.reused += 1
+                return conn, True
+            conn.close()
+
+        if scheme == "https":
+            reader, writer = await asyncio.open_connection(host, port,
+                    ssl = ssl.create_default_context())
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+
+        self.connections += 1
+        return CantoConnection(reader, writer), False
+
+    def release(self, key, conn):
+        conn.used = time.time()
+        conns = self.idle.setdefault(key, [])
+        if len(conns) < self.max_idle:
+            conns.append(conn)
+        else:
+            conn.close()
+
+    async def request(self, URL, headers):
+        parsed = urllib.parse.urlparse(URL)
+        scheme = parsed.scheme.lower()
+        if scheme not in [ "http", "https" ]:
+            raise FetchError("Unsupported scheme: %s" % URL)
+
+        port = parsed.port
+        if not port:
+            port = 443 if scheme == "https" else 80
+
+        key = (scheme, parsed.hostname, port)
+
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+
+        host = parsed.netloc.rpartition("@")[2]
+        lines = [ "GET %s HTTP/1.1" % path, "Host: %s" % host ]
+        for name, value in headers.items():
+            lines.append("%s: %s" % (name, value))
+        req = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        self.requests += 1
+
+        conn, reused = await self.connect(key)
+        try:
+            r = await self.exchange(conn, req)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            conn.close()
+
+            # A reused connection may have been closed by the server while
+            # it was idle, so try once more on a fresh one.
+
+            if not reused:
+                raise
+            conn, reused = await self.connect_fresh(key)
+            try:
+                r = await self.exchange(conn, req)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+
+        status, rheaders, body, keep_alive = r
+        if keep_alive:
+            self.release(key, conn)
+        else:
+            conn.close()
+        return status, rheaders, body
+
+    async def connect_fresh(self, key):
+        for conn in self.idle.pop(key, []):
+            conn.close()
+        return await self.connect(key)
+
+    async def exchange(self, conn, req):
+        conn.writer.write(req)
+        await conn.writer.drain()
+
+        reader = conn.reader
+
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed")
+
+        parts = line.decode("latin-1").split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise FetchError("Bad status line: %r" % line)
+
+        version = parts[0]
+        status = int(parts[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in [ b"\r\n", b"\n", b"" ]:
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            name = name.strip().lower()
+            value = value.strip()
+            if name in headers:
+                headers[name] += ", " + value
+            else:
+                headers[name] = value
+
+        connection = headers.get("connection", "").lower()
+        keep_alive = version == "HTTP/1.1" and "close" not in connection
+
+        if status in [ 204, 304 ] or 100 <= status < 200:
+            return status, headers, b"", keep_alive
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            body = await self.read_chunked(reader)
+        elif "content-length" in headers:
+            length = int(headers["content-length"])
+            if length > self.max_size:
+                raise FetchError("Body too large")
+            body = await reader.readexactly(length)
+        else:
+            body = await reader.read(self.max_size + 1)
+            while len(body) <= self.max_size:
+                more = await reader.read(self.max_size + 1 - len(body))
+                if not more:
+                    break
+                body += more
+            if len(body) > self.max_size:
+                raise FetchError("Body too large")
+            keep_alive = False
+
+        return status, headers, body, keep_alive
+
+    async def read_chunked(self, reader):
+        body = b""
+        while True:
+            line = await reader.readline()
+            size = int(line.split(b";")[0].strip(), 16)
+            if size == 0:
+                # Skip trailers.
+                while True:
+                    line = await reader.readline()
+                    if line in [ b"\r\n", b"\n", b"" ]:
+                        break
+                return body
+
+            if len(body) + size > self.max_size:
+                raise FetchError("Body too large")
+
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+
+    def stats(self):
+        return { "requests" : self.requests,
+                 "connections" : self.connections,
+                 "reused" : self.reused }
@@ -17,12 +17,13 @@ version = REPLACE_WITH_VERSION
 
 CANTO_PROTOCOL_VERSION = 0.3
 
-from .feed import allfeeds
+from .feed import allfeeds, allitems, expiry
 from .encoding import encoder
 from .protect import protection
 from .server import CantoServer
 from .config import CantoConfig
-from .storage import CantoShelf
+from .storage import CantoShelf, CantoSQLiteShelf, SYNC_INTERVAL, SYNC_BYTES,\
+        CACHE_BYTES, allcodecs, compressors
 from .fetch import CantoFetch
 from .hooks import on_hook, call_hook
 from .tag import alltags
@@ -50,9 +51,18 @@ logging.basicConfig(
 
 log = logging.getLogger("CANTO-DAEMON")
 
-FETCH_CHECK_INTERVAL = 60
+# Seconds between trims of the database file.
 TRIM_INTERVAL = 300
 
+# Seconds per idle pass spent hydrating lazily loaded feeds.
+WARM_UP_BUDGET = 0.05
+
+# Seconds per idle pass spent indexing fetched feeds.
+PROCESS_BUDGET = 0.05
+
+# Most items to expire per idle pass.
+EXPIRE_BATCH = 100
+
 class CantoBackend(CantoServer):
 
     # We want to invoke CantoServer's __init__ manually, and
@@ -67,22 +77,51 @@ class CantoBackend(CantoServer):
 
         # Shelf for feeds:
         self.fetch = None
-        self.fetch_timer = 0
 
-        # Timer to flush the database changes
+        # When to next flush the database changes
         # and trim the file down to size.
-        self.trim_timer = TRIM_INTERVAL
+        self.next_trim = time.time() + TRIM_INTERVAL
 
         # Whether fetching is inhibited.
         self.no_fetch = False
 
+        # Whether there are lazily loaded feeds left to hydrate.
+        self.warming = True
+
+        # Whether there are more expired items to remove.
+        self.expiring = False
+
+        # Whether there are more fetched feeds to index.
+        self.processing = False
+
         # Whether we should use the shelf writeback.
         self.writeback = True
 
+        # Which storage engine holds the feeds.
+        self.storage = "shelve"
+
+        # How long, and how many bytes, writes can be grouped before they're
+        # committed to disk.
+        self.sync_interval = SYNC_INTERVAL
+        self.sync_bytes = SYNC_BYTES
+
+        # Memory cap for decoded feed documents.
+        self.cache_bytes = CACHE_BYTES
+
+        # How feed documents are encoded on disk. None keeps whatever the
+        # database already uses (see CantoShelf).
+        self.codec = None
+        self.compression = None
+
         self.watches = { "new_tags" : [],
                          "del_tags" : [],
                          "config" : [],
-                         "tags" : {} }
+                         "tags" : {},
+                         "tag_deltas" : {} }
+
+        # { (socket, tag) : set(handles) } of what a socket watching deltas
+        # last saw of a transformed tag.
+        self.delta_views = {}
 
         self.autoattr = {}
 
@@ -164,7 +203,7 @@ class CantoBackend(CantoServer):
         for URL in list(allfeeds.dead_feeds.keys()):
             feed = allfeeds.dead_feeds[URL]
             for item in feed.items:
-                if protection.protected(item["id"]):
+                if protection.protected(item.handle):
                     log.debug("Dead feed %s still committed." % feed.URL)
                     break
             else:
@@ -182,6 +221,11 @@ class CantoBackend(CantoServer):
         self.check_dead_feeds()
         alltags.del_old_tags()
 
+        self.configure_fetch()
+
+        # New feeds may have been lazily loaded.
+        self.warming = True
+
     # Propagate config changes to watching sockets.
 
     # On_config_change must be prepared to have originating_socket = None for internal requests that
@@ -191,10 +235,10 @@ class CantoBackend(CantoServer):
 
         self._reparse_config(originating_socket)
 
-        # Force check of fetching. This automatically starts the fetch. For new
+        # Reschedule fetching. This automatically starts the fetch for new
         # feeds, but also takes any new settings (like rates) into account.
 
-        self.fetch_timer = 0
+        self.fetch.reschedule()
 
         # Pretend that the sockets *other* than the ones that made the change
         # issued a CONFIGS for each of the root keys.
@@ -217,6 +261,84 @@ class CantoBackend(CantoServer):
             for socket in self.watches["tags"][tag]:
                 self.write(socket, "TAGCHANGE", tag)
 
+    # Send deltas to sockets watching them. If the socket sees the tag through
+    # a transform, what was added and removed is worked out against what it
+    # last saw, otherwise it's just what happened to the tag. If the delta
+    # isn't known (the tags have been reset), or what the socket last saw
+    # can't be diffed against, it gets a plain TAGCHANGE.
+
+    def on_tag_delta(self, tag, delta):
+        if tag not in self.watches["tag_deltas"]:
+            return
+
+        for socket in self.watches["tag_deltas"][tag]:
+            if delta == None:
+                # Whatever the socket last saw is meaningless now, it will
+                # have to ask for ITEMS again.
+
+                if (socket, tag) in self.delta_views:
+                    del self.delta_views[(socket, tag)]
+                self.write(socket, "TAGCHANGE", tag)
+                continue
+
+            if self.transformed(socket, tag):
+                view = self.apply_transforms(socket, tag)
+                new = set(view)
+
+                # If there's no view, or items in it have since been released,
+                # we can't tell the socket what was removed.
+
+                old = None
+                if (socket, tag) in self.delta_views:
+                    old = self.delta_views[(socket, tag)]
+                    if [ h for h in old if h not in allitems ]:
+                        old = None
+
+                self.delta_views[(socket, tag)] = new
+
+                if old == None:
+                    self.write(socket, "TAGCHANGE", tag)
+                    continue
+
+                added = [ h for h in view if h not in old ]
+                removed = [ h for h in old if h not in new ]
+            else:
+                new = None
+                added = delta["added"]
+                removed = list(delta["removed"])
+
+                if [ h for h in added + removed if h not in allitems ]:
+                    self.write(socket, "TAGCHANGE", tag)
+                    continue
+
+            changed = {}
+            for handle in delta["changed"]:
+                if handle not in allitems:
+                    continue
+                if new == None or handle in new:
+                    changed[allitems.to_id(handle)] =\
+                            list(delta["changed"][handle])
+
+            if not (added or removed or changed):
+                continue
+
+            # Like ITEMS, protect what we hand out.
+
+            protection.protect((socket, "auto"), added)
+
+            r = { "tag" : tag,
+                  "added" : self.to_ids(added),
+                  "removed" : self.to_ids(removed),
+                  "changed" : changed }
+
+            self.write(socket, "TAGDELTA", r)
+
+            if added and socket in self.autoattr:
+                attr_req = {}
+                for handle in added:
+                    attr_req[handle] = self.autoattr[socket][:]
+                self.write(socket, "ATTRIBUTES", self.get_attributes(attr_req))
+
     # Notify clients of dead tags:
 
     def on_del_tag(self, tags):
@@ -240,6 +362,14 @@ class CantoBackend(CantoServer):
             while socket in self.watches["tags"][tag]:
                 self.watches["tags"][tag].remove(socket)
 
+        for tag in self.watches["tag_deltas"]:
+            while socket in self.watches["tag_deltas"][tag]:
+                self.watches["tag_deltas"][tag].remove(socket)
+
+        for key in list(self.delta_views.keys()):
+            if key[0] == socket:
+                del self.delta_views[key]
+
         if socket in list(self.socket_transforms.keys()):
             del self.socket_transforms[socket]
 
@@ -257,6 +387,7 @@ class CantoBackend(CantoServer):
         on_hook("del_tag", self.on_del_tag)
         on_hook("config_change", self.on_config_change)
         on_hook("tag_change", self.on_tag_change)
+        on_hook("tag_delta", self.on_tag_delta)
         on_hook("kill_socket", self.on_kill_socket)
 
         # For plugins
@@ -264,7 +395,32 @@ class CantoBackend(CantoServer):
         on_hook("del_configs", lambda x, y : self.queue_internal(x, self.in_delconfigs, y))
         on_hook("get_configs", lambda x, y : self.queue_internal(x, self.in_configs, y))
 
-    # Return list of item tuples after global transforms have
+    # Convert between the JSON IDs clients use and our item handles. IDs for
+    # items that no longer exist are dropped.
+
+    def to_handles(self, ids):
+        r = []
+        for i in ids:
+            handle = allitems.from_id(i)
+            if handle != None:
+                r.append(handle)
+        return r
+
+    def to_ids(self, handles):
+        return [ allitems.to_id(h) for h in handles ]
+
+    # Return whether a socket sees a tag through any transforms.
+
+    def transformed(self, socket, tag):
+        if self.conf.global_transform:
+            return True
+        if tag in alltags.tag_transforms and alltags.tag_transforms[tag]:
+            return True
+        if socket in self.socket_transforms and self.socket_transforms[socket]:
+            return True
+        return False
+
+    # Return list of item handles after global transforms have
     # been performed on them.
 
     def apply_transforms(self, socket, tag):
@@ -299,7 +455,6 @@ class CantoBackend(CantoServer):
 
     def do_fetch(self, force = False):
         self.fetch.fetch(force)
-        self.fetch_timer = FETCH_CHECK_INTERVAL
 
     # VERSION -> X.Y
 
@@ -311,6 +466,42 @@ class CantoBackend(CantoServer):
     def cmd_ping(self, socket, args):
         self.write(socket, "PONG", "")
 
+    # STATS -> { "storage" : { ... }, "expiry" : { ... }, "fetch" : { ... } }
+
+    # Internal counters, useful for tuning the daemon's settings.
+
+    def cmd_stats(self, socket, args):
+        r = { "storage" : self.shelf.stats(),
+              "expiry" : expiry.stats(),
+              "fetch" : self.fetch.stats() }
+        self.write(socket, "STATS", r)
+
+    # FETCHSTATUS [ "URL", ... ] -> { "URL" : { "state" : "closed", ... } }
+
+    # How fetching each feed (or all of them, if none are given) has been
+    # going: its circuit breaker "state", consecutive "failures", "last_error"
+    # and "last_failure" time, and "next_retry", along with the "last_update"
+    # and when it's scheduled to be fetched ("next_fetch", or None if it's
+    # being fetched now).
+
+    def cmd_fetchstatus(self, socket, args):
+        if args:
+            feeds = [ allfeeds.get_feed(URL) for URL in args ]
+        else:
+            feeds = allfeeds.get_feeds()
+
+        r = {}
+        for feed in feeds:
+            if not feed:
+                continue
+
+            status = dict(feed.health)
+            status["last_update"] = feed.last_update
+            status["next_fetch"] = self.fetch.scheduled.get(feed.URL)
+            r[feed.URL] = status
+
+        self.write(socket, "FETCHSTATUS", r)
+
     # LISTTAGS -> [ "tag1", "tag2", .. ]
     # This makes no guarantee on order *other* than the fact that
     # maintag tags will be first, and in feed order. Following tags
@@ -372,28 +563,35 @@ class CantoBackend(CantoServer):
     # ITEMS [tags] -> { tag : [ ids ], tag2 : ... }
 
     def cmd_items(self, socket, args):
-        ids = []
         response = {}
         attr_req = {}
 
         for tag in args:
             # get_tag returns a list invariably, but may be empty.
-            response[tag] = self.apply_transforms(socket, tag)
+            handles = self.apply_transforms(socket, tag)
 
             # ITEMS must protect all given items automatically to
             # avoid instances where an item disappears before a PROTECT
             # call can be made by the client.
 
-            protection.protect((socket, "auto"), response[tag])
+            protection.protect((socket, "auto"), handles)
 
             if socket in self.autoattr:
-                for id in response[tag]:
-                    attr_req[id] = self.autoattr[socket][:]
+                for handle in handles:
+                    attr_req[handle] = self.autoattr[socket][:]
+
+            # Deltas for transformed tags are relative to this.
+
+            if tag in self.watches["tag_deltas"] and\
+                    socket in self.watches["tag_deltas"][tag]:
+                self.delta_views[(socket, tag)] = set(handles)
+
+            response[tag] = self.to_ids(handles)
 
         self.write(socket, "ITEMS", response)
 
         if attr_req:
-            self.cmd_attributes(socket, attr_req)
+            self.write(socket, "ATTRIBUTES", self.get_attributes(attr_req))
 
     # FEEDATTRIBUTES { 'url' : [ attribs .. ] .. } ->
     # { url : { attribute : value } ... }
@@ -410,25 +608,64 @@ class CantoBackend(CantoServer):
     # ATTRIBUTES { id : [ attribs .. ] .. } ->
     # { id : { attribute : value } ... }
 
-    def cmd_attributes(self, socket, args):
+    # Internal, given { handle : [ attribs .. ] .. }
+
+    def get_attributes(self, attr_req):
         ret = {}
-        feeds = allfeeds.items_to_feeds(list(args.keys()))
+        feeds = allfeeds.items_to_feeds(list(attr_req.keys()))
+        for f in feeds:
+            for handle, attrs in f.get_attributes(feeds[f], attr_req).items():
+                ret[allitems.to_id(handle)] = attrs
+        return ret
+
+    def cmd_attributes(self, socket, args):
+        attr_req = {}
+        for i in args:
+            handle = allitems.from_id(i)
+            if handle != None:
+                attr_req[handle] = args[i]
+
+        self.write(socket, "ATTRIBUTES", self.get_attributes(attr_req))
+
+    # Internal, given { handle : { attribute : value } ... }. Each feed writes
+    # all of its changes at once, and the changes are announced to the
+    # affected tags in a single batch on the next work_done.
+
+    def set_attributes(self, attributes):
+        feeds = allfeeds.items_to_feeds(list(attributes.keys()))
         for f in feeds:
-            ret.update(f.get_attributes(feeds[f], args))
+            f.set_attributes(feeds[f], attributes)
 
-        self.write(socket, "ATTRIBUTES", ret)
+        for handle in attributes:
+            alltags.items_changed([ handle ], list(attributes[handle].keys()))
 
     # SETATTRIBUTES { id : { attribute : value } ... } -> None
 
     def cmd_setattributes(self, socket, args):
+        attributes = {}
+        for i in args:
+            handle = allitems.from_id(i)
+            if handle != None:
+                attributes[handle] = args[i]
 
-        feeds = allfeeds.items_to_feeds(list(args.keys()))
-        for f in feeds:
-            f.set_attributes(feeds[f], args)
+        self.set_attributes(attributes)
+
+    # SETTAGATTRIBUTES { tag : { attribute : value } ... } -> None
 
-        tags = alltags.items_to_tags(list(args.keys()))
-        for t in tags:
-            call_hook("tag_change", [ t ])
+    # Set attributes on every item that ITEMS would return for the tag, so
+    # clients can do things like mark a whole tag read without sending every
+    # ID back.
+
+    def cmd_settagattributes(self, socket, args):
+        attributes = {}
+        for tag in args:
+            for handle in self.apply_transforms(socket, tag):
+                if handle in attributes:
+                    attributes[handle].update(args[tag])
+                else:
+                    attributes[handle] = dict(args[tag])
+
+        self.set_attributes(attributes)
 
     # CONFIGS [ "top_sec", ... ] -> { "top_sec" : full_value }
 
@@ -519,18 +756,43 @@ class CantoBackend(CantoServer):
             else:
                 self.watches["tags"][tag] = [socket]
 
+    # WATCHTAGDELTAS [ "tag", ... ]
+
+    # Like WATCHTAGS, but instead of TAGCHANGE, send
+    # TAGDELTA { "tag" : tag, "added" : [ ids ], "removed" : [ ids ],
+    #            "changed" : { id : [ attributes ] } }
+    # with everything that's happened to the tag (as ITEMS would return it)
+    # since the last one. Added items are protected, as with ITEMS, and
+    # followed by ATTRIBUTES if AUTOATTR is set.
+
+    def cmd_watchtagdeltas(self, socket, args):
+        for tag in args:
+            log.debug("socket %s watching deltas for %s" % (socket, tag))
+            if tag in self.watches["tag_deltas"]:
+                self.watches["tag_deltas"][tag].append(socket)
+            else:
+                self.watches["tag_deltas"][tag] = [socket]
+
+            # Start from the current contents, in case the socket
+            # doesn't request ITEMS first.
+
+            if self.transformed(socket, tag):
+                self.delta_views[(socket, tag)] =\
+                        set(self.apply_transforms(socket, tag))
+
     # PROTECT { "reason" : [ id, ... ], ... }
 
     def cmd_protect(self, socket, args):
         for reason in args:
-            protection.protect((socket, reason), args[reason])
+            handles = self.to_handles(args[reason])
+            protection.protect((socket, reason), handles)
 
     # UNPROTECT { "reason" : [ id, ... ], ... }
 
     def cmd_unprotect(self, socket, args):
         for reason in args:
-            for id in args[reason]:
-                protection.unprotect_one((socket, reason), id)
+            for handle in self.to_handles(args[reason]):
+                protection.unprotect_one((socket, reason), handle)
 
     # UPDATE {}
 
@@ -565,10 +827,20 @@ class CantoBackend(CantoServer):
                 # It really sucks that we don't get signals will in a Queue.get
                 # =(
 
-                if self.alarmed:
-                    r = self.queue.get(True, 0.1)
-                else:
-                    r = self.queue.get(True, 1)
+                # We also spin faster while there are feeds to warm up or index,
+                # or items to expire, and wake up early if a feed is due.
+
+                timeout = 1
+                if self.alarmed or self.warming or self.expiring or\
+                        self.processing:
+                    timeout = 0.1
+
+                if not self.no_fetch:
+                    wakeup = self.fetch.next_wakeup()
+                    if wakeup != None:
+                        timeout = max(0.01, min(timeout, wakeup))
+
+                r = self.queue.get(True, timeout)
 
                 log.debug("!!! %s" % (r,))
 
@@ -619,32 +891,43 @@ class CantoBackend(CantoServer):
 
             self.no_dead_conns()
 
-            # Process any possible feed updates.
+            # Process any possible feed updates. They've been merged by the
+            # fetch threads, so this is mostly swapping them in.
+
+            self.processing = self.fetch.process(PROCESS_BUDGET)
 
-            self.fetch.process()
+            # Hydrate lazily loaded feeds a few at a time, so that we can
+            # still respond to requests in between.
 
-            # Decrement all timers
+            if self.warming:
+                self.warming = allfeeds.warm_up(WARM_UP_BUDGET)
+                if not self.warming:
+                    log.debug("All feeds hydrated.")
 
-            self.fetch_timer -= 1
-            self.trim_timer -= 1
+            # Remove expired items, a batch at a time.
 
-            # Check whether feeds need to be updated and fetch
-            # them if necessary.
+            self.expiring = expiry.expire(EXPIRE_BATCH)
 
-            if self.fetch_timer <= 0 and not self.no_fetch:
+            # Fetch any feeds that have come due. This is just a look at the
+            # top of the schedule.
+
+            if not self.no_fetch:
                 self.do_fetch()
 
-            # Trim the database file.
+            # Trim the database file. The loop spins faster while there's work
+            # to do, so this goes by the clock rather than by passes.
 
-            if self.trim_timer <= 0:
+            if time.time() >= self.next_trim:
                 self.shelf.trim()
-                self.trim_timer = TRIM_INTERVAL
+                self.next_trim = time.time() + TRIM_INTERVAL
 
     # This function parses and validates all of the command line arguments.
     def args(self):
         try:
             optlist = getopt.getopt(sys.argv[1:], 'D:vp:a:nV',\
-                    ["dir=", "port=", "address=", "nofetch", "nowb"])[0]
+                    ["dir=", "port=", "address=", "nofetch", "nowb",
+                     "storage=", "sync-interval=", "sync-bytes=",
+                     "cache-bytes=", "codec=", "compress="])[0]
         except getopt.GetoptError as e:
             log.error("Error: %s" % e.msg)
             return -1
@@ -679,6 +962,51 @@ class CantoBackend(CantoServer):
             elif opt in ["--nowb"]:
                 self.writeback = False
 
+            elif opt in ["--storage"]:
+                if arg not in ["shelve", "sqlite"]:
+                    log.error("Error: Storage must be shelve or sqlite.")
+                    return -1
+                self.storage = arg
+
+            elif opt in ["--sync-interval"]:
+                try:
+                    self.sync_interval = int(arg)
+                    if self.sync_interval < 0:
+                        raise Exception
+                except:
+                    log.error("Error: Sync interval must be >=0 integer.")
+                    return -1
+
+            elif opt in ["--sync-bytes"]:
+                try:
+                    self.sync_bytes = int(arg)
+                    if self.sync_bytes < 0:
+                        raise Exception
+                except:
+                    log.error("Error: Sync bytes must be >=0 integer.")
+                    return -1
+
+            elif opt in ["--cache-bytes"]:
+                try:
+                    self.cache_bytes = int(arg)
+                    if self.cache_bytes < 0:
+                        raise Exception
+                except:
+                    log.error("Error: Cache bytes must be >=0 integer.")
+                    return -1
+
+            elif opt in ["--codec"]:
+                if arg not in allcodecs:
+                    log.error("Error: Unknown codec: %s" % arg)
+                    return -1
+                self.codec = arg
+
+            elif opt in ["--compress"]:
+                if arg not in compressors:
+                    log.error("Error: Unsupported compression: %s" % arg)
+                    return -1
+                self.compression = arg
+
             elif opt in ['-V']:
                 print("canto-daemon " + version)
                 return 1
@@ -715,7 +1043,7 @@ class CantoBackend(CantoServer):
         return self.ensure_files()
 
     def ensure_files(self):
-        for f in [ "feeds", "conf", "daemon-log", "pid"]:
+        for f in [ "feeds", "feeds.sqlite", "conf", "daemon-log", "pid"]:
             p = self.conf_dir + "/" + f
             if os.path.exists(p):
                 if not os.path.isfile(p):
@@ -731,6 +1059,7 @@ class CantoBackend(CantoServer):
         # These paths are now guaranteed to read/writable.
 
         self.feed_path = self.conf_dir + "/feeds"
+        self.sqlite_path = self.conf_dir + "/feeds.sqlite"
         self.pid_path = self.conf_dir + "/pid"
         self.log_path = self.conf_dir + "/daemon-log"
         self.conf_path = self.conf_dir + "/conf"
@@ -767,7 +1096,17 @@ class CantoBackend(CantoServer):
     # fatal and handled lower in CantoShelf.
 
     def get_storage(self):
-        self.shelf = CantoShelf(self.feed_path, self.writeback)
+        if self.storage == "sqlite":
+            self.shelf = CantoSQLiteShelf(self.sqlite_path, self.writeback,
+                    self.sync_interval, self.sync_bytes, self.cache_bytes,
+                    self.codec, self.compression)
+
+            # On first start, move over anything in the old shelve file.
+            self.shelf.migrate(self.feed_path)
+        else:
+            self.shelf = CantoShelf(self.feed_path, self.writeback,
+                    self.sync_interval, self.sync_bytes, self.cache_bytes,
+                    self.codec, self.compression)
 
     # Bring up config, the only errors possible at this point will
     # be fatal and handled lower in CantoConfig.
@@ -784,8 +1123,25 @@ class CantoBackend(CantoServer):
 
             sys.exit(-1)
 
+    # The fetch pool is built from the config up front, so its threads and
+    # parse pool are only started once.
+
     def get_fetch(self):
-        self.fetch = CantoFetch(self.shelf)
+        self.fetch = CantoFetch(self.shelf, **self.fetch_config())
+        self.fetch.reschedule()
+
+    def configure_fetch(self):
+        self.fetch.configure(**self.fetch_config())
+
+    def fetch_config(self):
+        return { "threads" : self.conf.fetch_threads,
+                 "host_threads" : self.conf.fetch_host_threads,
+                 "parse_workers" : self.conf.parse_workers,
+                 "parse_mode" : self.conf.parse_mode,
+                 "engine" : self.conf.fetch_engine,
+                 "timeout" : self.conf.fetch_timeout,
+                 "max_size" : self.conf.fetch_max_size,
+                 "host_rates" : self.conf.host_rates }
 
     def start(self):
         try:
@@ -59,6 +59,19 @@ class CantoConfig():
                 ("keep_time", self.validate_int, False),
                 ("keep_unread", self.validate_bool, False),
                 ("global_transform", self.validate_set_transform, False),
+                ("store_attributes", self.validate_string_list, False),
+                ("drop_attributes", self.validate_string_list, False),
+                ("cold_attributes", self.validate_string_list, False),
+                ("hot_attributes", self.validate_string_list, False),
+                ("lazy", self.validate_bool, False),
+                ("fetch_threads", self.validate_positive_int, False),
+                ("fetch_host_threads", self.validate_positive_int, False),
+                ("parse_workers", self.validate_positive_int, False),
+                ("parse_mode", self.validate_parse_mode, False),
+                ("fetch_engine", self.validate_fetch_engine, False),
+                ("fetch_timeout", self.validate_positive_int, False),
+                ("fetch_max_size", self.validate_positive_int, False),
+                ("host_rates", self.validate_host_rates, False),
         ]
 
         self.defaults_defaults = {
@@ -66,6 +79,20 @@ class CantoConfig():
                 "keep_time" : 86400,
                 "keep_unread" : False,
                 "global_transform" : "None",
+                "store_attributes" : [],
+                "drop_attributes" : [],
+                "cold_attributes" : [],
+                "hot_attributes" : [ "title", "canto-state", "canto_update",
+                    "link" ],
+                "lazy" : False,
+                "fetch_threads" : 8,
+                "fetch_host_threads" : 2,
+                "parse_workers" : 2,
+                "parse_mode" : "thread",
+                "fetch_engine" : "urllib",
+                "fetch_timeout" : 60,
+                "fetch_max_size" : 8 * 1024 * 1024,
+                "host_rates" : {},
         }
 
         self.feed_validators = [
@@ -76,6 +103,10 @@ class CantoConfig():
                 ("keep_unread", self.validate_bool, False),
                 ("username", self.validate_string, False),
                 ("password", self.validate_string, False),
+                ("store_attributes", self.validate_string_list, False),
+                ("drop_attributes", self.validate_string_list, False),
+                ("cold_attributes", self.validate_string_list, False),
+                ("hot_attributes", self.validate_string_list, False),
         ]
 
         self.feed_defaults = {}
@@ -152,6 +183,50 @@ class CantoConfig():
             return False
         return (True, value)
 
+    def validate_positive_int(self, ident, value):
+        if not self.validate_int(ident, value):
+            return False
+        if value < 1:
+            self.error(ident, value, "Not positive!")
+            return False
+        return (True, value)
+
+    def validate_parse_mode(self, ident, value):
+        if value not in [ "process", "thread" ]:
+            self.error(ident, value, "Not \"process\" or \"thread\"!")
+            return False
+        return (True, value)
+
+    def validate_fetch_engine(self, ident, value):
+        if value not in [ "urllib", "async" ]:
+            self.error(ident, value, "Not \"urllib\" or \"async\"!")
+            return False
+        return (True, value)
+
+    # { "host pattern" : { "interval" : seconds, "burst" : requests } }
+
+    def validate_host_rates(self, ident, value):
+        if type(value) != dict:
+            self.error(ident, value, "Not dict!")
+            return False
+
+        for pattern, rate in value.items():
+            rate_ident = ident + ("[%s]" % pattern)
+            if type(rate) != dict or "interval" not in rate:
+                self.error(rate_ident, rate, "No interval!")
+                return False
+
+            interval = rate["interval"]
+            if type(interval) not in [ int, float ] or interval < 0:
+                self.error(rate_ident, interval, "Invalid interval!")
+                return False
+
+            if "burst" in rate and not\
+                    self.validate_positive_int(rate_ident, rate["burst"]):
+                return False
+
+        return (True, value)
+
     def validate_string(self, ident, value):
         if type(value) != str:
             self.error(ident, value, "Not unicode!")
@@ -312,6 +387,17 @@ class CantoConfig():
                     if k in feed:
                         kws[k] = feed[k]
 
+                # Optional arguments that fall back to defaults
+                for k in ["store_attributes", "drop_attributes",\
+                        "cold_attributes", "hot_attributes"]:
+                    if k in feed:
+                        kws[k] = feed[k]
+                    else:
+                        kws[k] = self.final["defaults"][k]
+
+                # Daemon wide
+                kws["lazy"] = self.final["defaults"]["lazy"]
+
                 feed = CantoFeed(self.shelf, feed["name"],\
                         feed["url"], feed["rate"], feed["keep_time"], feed["keep_unread"], **kws)
 
@@ -329,6 +415,17 @@ class CantoConfig():
         self.global_transform = eval_transform(\
                 self.final["defaults"]["global_transform"])
 
+        # Fetch pool settings, picked up by the backend.
+
+        self.fetch_threads = self.final["defaults"]["fetch_threads"]
+        self.fetch_host_threads = self.final["defaults"]["fetch_host_threads"]
+        self.parse_workers = self.final["defaults"]["parse_workers"]
+        self.parse_mode = self.final["defaults"]["parse_mode"]
+        self.fetch_engine = self.final["defaults"]["fetch_engine"]
+        self.fetch_timeout = self.final["defaults"]["fetch_timeout"]
+        self.fetch_max_size = self.final["defaults"]["fetch_max_size"]
+        self.host_rates = self.final["defaults"]["host_rates"]
+
     # Delete settings from the JSON. Any key equal to "DELETE" will be removed,
     # keys that are lists will items removed if specified.
 
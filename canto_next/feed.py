@@ -10,9 +10,14 @@
 from .plugins import PluginHandler, Plugin
 from .protect import protection
 from .encoding import encoder
+from .hooks import on_hook
 from .tag import alltags
 
+from feedparser import FeedParserDict
 import traceback
+import hashlib
+import heapq
+import fnmatch
 import logging
 import json
 import time
@@ -24,6 +29,238 @@ def dict_id(i):
         return i
     return json.loads(i)
 
+# Stored content is made of plain dicts rather than FeedParserDicts, so
+# resolve feedparser's aliases (like "description" for "summary") ourselves.
+
+aliases = getattr(FeedParserDict, "keymap", {})
+
+# Return the attribute names that attr could be stored under.
+
+def attr_names(attr):
+    r = [ attr ]
+    if attr in aliases:
+        if type(aliases[attr]) == list:
+            r += aliases[attr]
+        else:
+            r.append(aliases[attr])
+    return r
+
+def get_attr(d, attr):
+    for realattr in attr_names(attr):
+        if realattr in d:
+            return d[realattr]
+    return ""
+
+# Fingerprint the content of a fresh entry, or feed (minus its entries and the
+# HTTP headers, which change every fetch), ignoring our own attributes.
+
+def fingerprint(d):
+    content = []
+    for key in d:
+        if key in ["entries", "headers"] or key.startswith("canto"):
+            continue
+        content.append((key, d[key]))
+    return hashlib.sha1(repr(content).encode("UTF-8")).hexdigest()
+
+# Large item attributes can be moved out of the feed document into a record of
+# their own, that's only loaded when a client actually asks for them. Entries
+# with such a record list the attributes in canto_cold.
+
+def cold_key(URL, ID):
+    # URLs never contain spaces, so this can't be ambiguous.
+    return "cold:%s %s" % (URL, ID)
+
+# Every feed also has a small summary record (its item IDs, in order, the time
+# of the last update, and the HTTP cache validators from the last fetch) so
+# that lazy feeds can be set up without reading their full content.
+
+def summary_key(URL):
+    return "summary:%s" % URL
+
+# What's kept from each fetch to tell whether the next one has anything new:
+# the ETag, Last-Modified, length and a digest of the body.
+
+VALIDATORS = [ "canto_etag", "canto_modified", "canto_length", "canto_digest" ]
+
+# How fetching a feed has been going: its circuit breaker state ("closed",
+# "open" after too many failures, or "half-open" while it's being retried),
+# consecutive failures, the last error and when it happened, and the earliest
+# it should be fetched again. CantoFetch decides what these are.
+
+def new_health():
+    return { "state" : "closed",
+             "failures" : 0,
+             "last_error" : None,
+             "last_failure" : 0,
+             "next_retry" : 0 }
+
+def match_any(attr, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(attr, pattern):
+            return True
+    return False
+
+# Items are tracked internally by an integer handle, rather than the JSON ID
+# clients see ({ "URL" : feed URL, "ID" : feed level ID }), which is only built
+# and parsed at the protocol boundary. Tags, protection and transforms all deal
+# in handles.
+
+class CantoItem():
+    __slots__ = [ "handle", "feed", "raw_id", "hot" ]
+
+    def __init__(self, handle, feed, raw_id):
+        self.handle = handle
+        self.feed = feed
+        self.raw_id = raw_id
+
+        # Values of feed.hot_attributes, in the same order, or None if they
+        # haven't been filled in.
+        self.hot = None
+
+# Marks a hot attribute that has to be read from disk anyway.
+NOT_CACHED = object()
+
+class CantoItems():
+    def __init__(self):
+        self.records = {}
+        self.by_url = {}
+        self.next_handle = 0
+        self.released = []
+
+        on_hook("work_done", self.forget_released)
+
+    def __getitem__(self, handle):
+        return self.records[handle]
+
+    def __contains__(self, handle):
+        return handle in self.records
+
+    # Return the record for an item, creating it if necessary. Items keep their
+    # handle for as long as they're in a feed, even across config changes that
+    # replace the feed object.
+
+    def register(self, feed, raw_id):
+        if feed.URL not in self.by_url:
+            self.by_url[feed.URL] = {}
+        handles = self.by_url[feed.URL]
+
+        if raw_id in handles:
+            record = self.records[handles[raw_id]]
+            if record.feed is not feed:
+                record.feed = feed
+                record.hot = None
+            return record
+
+        record = CantoItem(self.next_handle, feed, raw_id)
+        self.next_handle += 1
+
+        self.records[record.handle] = record
+        handles[raw_id] = record.handle
+        return record
+
+    def lookup(self, URL, raw_id):
+        if URL in self.by_url and raw_id in self.by_url[URL]:
+            return self.by_url[URL][raw_id]
+        return None
+
+    # Released items can't be looked up by ID anymore, but the records stay
+    # around until the next work_done (after tag changes have gone out) so
+    # their IDs can still be reported to clients.
+
+    def release(self, handle):
+        if handle not in self.records:
+            return
+
+        record = self.records[handle]
+        URL = record.feed.URL
+
+        if URL in self.by_url and\
+                self.by_url[URL].get(record.raw_id) == handle:
+            del self.by_url[URL][record.raw_id]
+            if not self.by_url[URL]:
+                del self.by_url[URL]
+            self.released.append(handle)
+
+    def forget_released(self):
+        for handle in self.released:
+            del self.records[handle]
+        self.released = []
+
+    # Convert to and from the JSON IDs used in the protocol. Unknown IDs are
+    # None.
+
+    def to_id(self, handle):
+        record = self.records[handle]
+        return json.dumps({ "URL" : record.feed.URL, "ID" : record.raw_id })
+
+    def from_id(self, i):
+        try:
+            d_i = dict_id(i)
+            return self.lookup(d_i["URL"], d_i["ID"])
+        except:
+            log.debug("Bad item ID: %s" % (i,))
+            return None
+
+allitems = CantoItems()
+
+# Items that have dropped out of their feed are removed keep_time after they
+# were last seen. Rather than checking every item on every update, all of the
+# expiry times go into one heap that the daemon drains a few at a time.
+
+# How long to wait before checking a protected item again.
+PROTECTED_RETRY = 60
+
+class CantoExpiry():
+    def __init__(self):
+        # (expiry time, item handle) heap. Entries that no longer match the
+        # item's feed.expiring are stale and ignored.
+        self.heap = []
+        self.expired = 0
+
+    def schedule(self, handle, when):
+        heapq.heappush(self.heap, (when, handle))
+
+    # Expire up to batch items that are due. Returns whether there are more
+    # items due.
+
+    def expire(self, batch):
+        now = time.time()
+        due = {}
+
+        while self.heap and self.heap[0][0] <= now and batch > 0:
+            when, handle = heapq.heappop(self.heap)
+            batch -= 1
+
+            if handle not in allitems:
+                continue
+
+            feed = allitems[handle].feed
+            if allfeeds.feeds.get(feed.URL) is not feed:
+                continue
+
+            if handle not in feed.expiring or feed.expiring[handle] != when:
+                continue
+
+            if protection.protected(handle):
+                feed.expiring[handle] = now + PROTECTED_RETRY
+                self.schedule(handle, now + PROTECTED_RETRY)
+                continue
+
+            if feed in due:
+                due[feed].append(handle)
+            else:
+                due[feed] = [ handle ]
+
+        for feed in due:
+            self.expired += feed.expire(due[feed])
+
+        return self.heap != [] and self.heap[0][0] <= now
+
+    def stats(self):
+        return { "scheduled" : len(self.heap), "expired" : self.expired }
+
+expiry = CantoExpiry()
+
 class CantoFeeds():
     def __init__(self):
         self.order = []
@@ -47,22 +284,32 @@ class CantoFeeds():
 
     def items_to_feeds(self, items):
         f = {}
+        records = allitems.records
         for i in items:
-            d_i = dict_id(i)
-
-            if d_i["URL"] in self.feeds:
-                feed = self.feeds[d_i["URL"]]
-            elif d_i["URL"] in self.dead_feeds:
-                feed = self.dead_feeds[d_i["URL"]]
-            else:
-                raise Exception("Can't find feed: %s" % d_i["URL"])
+            if i not in records:
+                raise Exception("Can't find item: %s" % (i,))
 
+            feed = records[i].feed
             if feed in f:
                 f[feed].append(i)
             else:
                 f[feed] = [i]
         return f
 
+    # Hydrate lazily loaded feeds until we've spent budget seconds doing so.
+    # Returns whether there are any feeds left to hydrate.
+
+    def warm_up(self, budget):
+        start = time.time()
+        for URL in self.order:
+            feed = self.feeds[URL]
+            if feed.hydrated:
+                continue
+            if time.time() - start >= budget:
+                return True
+            feed.hydrate()
+        return False
+
     def really_dead(self, feed):
         if feed.URL in self.dead_feeds:
             del self.dead_feeds[feed.URL]
@@ -75,6 +322,43 @@ class CantoFeeds():
 
 allfeeds = CantoFeeds()
 
+# New content for a feed, merged with what's on disk by CantoFeed.merge(), and
+# waiting for CantoFeed.commit() to swap it in.
+
+class CantoMerged():
+    def __init__(self, generation, contents):
+        # The feed's generation when the merge started, and the contents it
+        # was merged from, untouched, in case it has to be done over.
+        self.generation = generation
+        self.contents = contents
+
+        self.fresh = contents != None
+
+        # The new feed document. Its entries start with the ones in the feed,
+        # followed by the old entries at positions carried in self.items.
+        self.doc = None
+        self.in_feed = 0
+        self.carried = []
+
+        # Hot attribute values for each entry, see CantoItem.
+        self.hot = []
+
+        # Times the merge has been redone after going stale.
+        self.tries = 0
+
+        # Feed IDs of entries that need writing, { feed ID : [ attributes ] }
+        # that changed in existing entries, the old entries that are gone, and
+        # { feed ID : cold record } to write.
+        self.changed = set()
+        self.attrs = {}
+        self.removed = []
+        self.cold = {}
+
+        # Whether there was nothing on disk, and whether anything needs to be
+        # written.
+        self.stub = False
+        self.dirty = False
+
 class DaemonFeedPlugin(Plugin):
     pass
 
@@ -101,36 +385,229 @@ class CantoFeed(PluginHandler):
         if "password" in kwargs:
             self.password = kwargs["password"]
 
+        # Which entry attributes to write to disk (all, if empty), which to
+        # discard, and which to keep in the cold store. All are lists of
+        # fnmatch patterns.
+
+        self.store_attributes = []
+        if "store_attributes" in kwargs:
+            self.store_attributes = kwargs["store_attributes"]
+
+        self.drop_attributes = []
+        if "drop_attributes" in kwargs:
+            self.drop_attributes = kwargs["drop_attributes"]
+
+        self.cold_attributes = []
+        if "cold_attributes" in kwargs:
+            self.cold_attributes = kwargs["cold_attributes"]
+
+        # Which entry attributes to keep in self.items, so they can be served
+        # without going to disk. The "id" in self.items is our own, so it
+        # can't be cached.
+
+        self.hot_attributes = [ "title", "canto-state", "canto_update", "link" ]
+        if "hot_attributes" in kwargs:
+            self.hot_attributes = kwargs["hot_attributes"]
+
+        self.hot_attributes = [ a for a in self.hot_attributes if a != "id" ]
+
+        # { hot attribute : position in CantoItem.hot }
+        self.hot_index = {}
+        for i, attr in enumerate(self.hot_attributes):
+            self.hot_index[attr] = i
+
         self.update_contents = None
+
+        # CantoItem records, in the same order as the entries on disk.
         self.items = []
 
-        # Pull items from disk on instantiation.
-        self.index()
+        # Time of the last successful update. This is only written to the
+        # feed content when something else in the feed changes, but it's
+        # always in the summary.
+        self.last_update = 0
 
-    # Return whether item, if added, would have a unique ID
-    def unique_item(self, item):
-        for cur_item in self.items:
-            # Just the non-URL part will match
-            if dict_id(cur_item["id"])["ID"] == item["id"]:
-                return False
+        # { item handle : position in self.items } and the set of raw (feed
+        # level) IDs in self.items, so lookups don't have to scan.
+        self.item_index = {}
+        self.raw_ids = set()
+
+        # Whether self.items has been checked against the full content on
+        # disk, rather than just set up from the summary.
+        self.hydrated = False
+
+        # { validator : value } from the last fetch, see VALIDATORS.
+        self.validators = {}
+
+        # See new_health().
+        self.health = new_health()
+
+        # { item handle : expiry time } for items no longer in the feed.
+        self.expiring = {}
+
+        # Bumped whenever self.items or the content on disk changes, so that
+        # a merge done in the background can tell whether it's still good.
+        self.generation = 0
+
+        # A CantoMerged of fetched content, set by the fetch threads, waiting
+        # to be committed.
+        self.merged = None
+
+        # Pull items from disk on instantiation. Lazy feeds only read their
+        # summary, and are hydrated by warm_up() or when they're first fetched.
+
+        if "lazy" in kwargs and kwargs["lazy"] and self.load_summary():
+            log.debug("Lazily loaded %s" % self.URL)
+        else:
+            self.load_fetch_state()
+            self.index()
+
+    # Set up self.items and tags from the summary record, if there is one.
+
+    def load_summary(self):
+        key = summary_key(self.URL)
+        if key not in self.shelf:
+            return False
+
+        summary = self.shelf[key]
+
+        # This is the bulk of startup for lazy feeds, so build the lists
+        # directly rather than going through add_item.
+
+        name = self.name
+        items = []
+        item_index = {}
+
+        for raw_id in summary["ids"]:
+            item = allitems.register(self, raw_id)
+            alltags.add_tag(item.handle, name, "maintag")
+            item_index[item.handle] = len(items)
+            items.append(item)
+
+        self.items = items
+        self.item_index = item_index
+        self.raw_ids = set(summary["ids"])
+
+        self.last_update = summary["canto_update"]
+
+        if "validators" in summary:
+            self.validators = dict(summary["validators"])
+        if "health" in summary:
+            self.health = dict(summary["health"])
         return True
 
-    # Remove old items from all tags.
+    # Just get the update time, validators and health from the summary. The
+    # update time in the content on disk may be older, if later fetches found
+    # nothing new. The summary is the shelf's cached copy, so take our own.
+
+    def load_fetch_state(self):
+        key = summary_key(self.URL)
+        if key not in self.shelf:
+            return
+
+        summary = self.shelf[key]
+        self.last_update = summary["canto_update"]
+        if "validators" in summary:
+            self.validators = dict(summary["validators"])
+        if "health" in summary:
+            self.health = dict(summary["health"])
+
+    def write_summary(self, ids):
+        self.shelf[summary_key(self.URL)] =\
+                { "ids" : ids, "canto_update" : self.last_update,
+                  "validators" : self.validators, "health" : self.health }
+
+    # Set and persist the feed's health, after a fetch failed, or succeeded
+    # after failing.
+
+    def set_health(self, health):
+        self.health = health
+        self.write_summary([ i.raw_id for i in self.items ])
+
+    # The feed was fetched, but hadn't been modified, or was identical to the
+    # last fetch. Just bump the update time, and keep any new validators. The items are unchanged, so this
+    # doesn't require the feed to be hydrated.
+
+    def touch(self, touched):
+        self.last_update = max(self.last_update, touched["canto_update"])
+
+        validators = {}
+        for key in VALIDATORS:
+            if key in touched:
+                validators[key] = touched[key]
+        self.validators = validators
+
+        self.write_summary([ i.raw_id for i in self.items ])
+
+    # Index from disk, without disturbing any update waiting to be indexed.
+
+    def hydrate(self):
+        if self.hydrated:
+            return
+
+        log.debug("Hydrating %s" % self.URL)
+
+        # index() expects self.items to line up with the entries on disk, if
+        # the summary was stale, start over.
+
+        if self.URL in self.shelf:
+            ids = [ e["id"] for e in self.shelf[self.URL]["entries"] ]
+        else:
+            ids = []
+
+        stale = []
+        if ids != [ i.raw_id for i in self.items ]:
+            log.debug("Summary for %s out of date." % self.URL)
+            stale = self.items
+            self.items = []
+            self.item_index = {}
+            self.raw_ids = set()
+
+        self.commit(self.merge(None))
+        self.clear_tags(stale)
+
+    # Append to self.items, keeping the indices up to date.
+    def add_item(self, item):
+        self.item_index[item.handle] = len(self.items)
+        self.raw_ids.add(item.raw_id)
+        self.items.append(item)
+
+    # Remove old items from all tags, and forget them.
     def clear_tags(self, olditems):
+        gone = []
         for olditem in olditems:
-            for item in self.items:
-                # Same ID exists in new items
-                if item["id"] == olditem["id"]:
+            # Same ID exists in new items
+            if olditem.handle not in self.item_index:
+                gone.append(olditem.handle)
+                if olditem.feed is self:
+                    allitems.release(olditem.handle)
+
+        alltags.remove_ids(gone)
+
+    # Return the hot attribute values for an entry, for CantoItem.hot.
+    # Attributes that have been moved to the cold store are left to be read
+    # from disk.
+
+    def hot_values(self, entry):
+        hot = []
+        for attr in self.hot_attributes:
+            names = attr_names(attr)
+            for realattr in names:
+                if realattr in entry:
+                    hot.append(entry[realattr])
                     break
             else:
-                alltags.remove_id(olditem["id"])
+                if "canto_cold" in entry and\
+                        [ x for x in names if x in entry["canto_cold"] ]:
+                    hot.append(NOT_CACHED)
+                else:
+                    hot.append("")
+        return hot
 
     def lookup_by_id(self, i):
-        for idx, ci in enumerate(self.items):
-            if ci["id"] == i:
-                return (ci, idx)
-        else:
+        if i not in self.item_index:
             raise Exception("%s not found in self.items" % (i,))
+        idx = self.item_index[i]
+        return (self.items[idx], idx)
 
     # Return { attribute : value ... }
     def get_feedattributes(self, attributes):
@@ -138,81 +615,153 @@ class CantoFeed(PluginHandler):
 
         r = {}
         for attr in attributes:
-            if attr in d:
-                r[attr] = d[attr]
+            if attr == "canto_update":
+                r[attr] = self.last_update
             else:
-                r[attr] = ""
+                r[attr] = get_attr(d, attr)
         return r
 
-    # Return { id : { attribute : value .. } .. }
+    # Return { handle : { attribute : value .. } .. }
     def get_attributes(self, items, attributes):
         r = {}
 
-        for i in items:
-            attrs = {}
+        # Items with attributes we don't have in memory, by feed level ID, so
+        # all of the disk content can be fetched at once.
 
-            # Grab cached item
-            try:
-                item_cache, item_idx = self.lookup_by_id(i)
-            except:
+        cached = {}
+        uncached = []
+
+        # Transforms call this for every item in a tag, so avoid attribute
+        # lookups (which go through the plugin machinery) in the loops.
+
+        item_index = self.item_index
+        records = self.items
+        hot_index = self.hot_index
+
+        for i in items:
+            # Grab item record
+            if i not in item_index:
                 continue
 
-            # Potential fetched disk data.
-            d = None
+            item = records[item_index[i]]
+            cached[i] = item
+
+            hot = item.hot
+            for a in attributes[i]:
+                if hot == None or a not in hot_index or\
+                        hot[hot_index[a]] is NOT_CACHED:
+                    uncached.append(item.raw_id)
+                    break
+
+        # Potential fetched disk data, { feed ID : entry }. Only the needed
+        # items are pulled, so storage engines with per-item records don't
+        # have to load the whole feed.
+
+        d = {}
+        if uncached:
+            d = self.shelf.get_items(self.URL, uncached)
+
+        for i in cached:
+            item = cached[i]
+            hot = item.hot
+            attrs = {}
+            disk_item = None
 
             # Get attributes
             for a in attributes[i]:
 
-                # Cached attribute
-                if a in item_cache:
-                    attrs[a] = ci[a]
+                # Items still in the feed were last seen at the last fetch.
+                # That's only written to the entry when something else about
+                # it changes, so their canto_update on disk is when they last
+                # changed.
 
-                # Disk attribute
-                else:
+                if a == "canto_update" and self.last_update and\
+                        i not in self.expiring:
+                    attrs[a] = self.last_update
+                    continue
 
-                    # If we haven't already grabbed the disk content, do so.
-                    if not d:
-                        d = self.shelf[self.URL]
+                # Cached attribute
+                if hot != None and a in hot_index and\
+                        hot[hot_index[a]] is not NOT_CACHED:
+                    attrs[a] = hot[hot_index[a]]
+                    continue
 
-                    # NOTE: This relies on self.items maintaining
-                    # the identical order to the entries on disk.
-                    # Must be enforced by self.index()
+                # Disk attribute
 
-                    disk_item = d["entries"][item_idx]
-                    if a in disk_item:
-                        attrs[a] = disk_item[a]
-                    else:
-                        attrs[a] = ""
+                if disk_item == None:
+                    disk_item = d.get(item.raw_id, {})
+
+                # Pull in the cold record, if this is the first cold
+                # attribute requested for this item. Attributes set since the
+                # record was written are in the entry itself, and win.
+
+                if "canto_cold" in disk_item and [ x for x in\
+                        attr_names(a) if x in disk_item["canto_cold"] ]:
+                    disk_item = dict(disk_item)
+                    del disk_item["canto_cold"]
+                    key = cold_key(self.URL, disk_item["id"])
+                    if key in self.shelf:
+                        for k, v in self.shelf[key].items():
+                            if k not in disk_item:
+                                disk_item[k] = v
+                    d[item.raw_id] = disk_item
+
+                attrs[a] = get_attr(disk_item, a)
             r[i] = attrs
         return r
 
     # Given an ID and a dict of attributes, update the disk.
     def set_attributes(self, items, attributes):
 
-        d = self.shelf[self.URL]
+        updates = {}
+
+        # This can be every item in a tag at once, so avoid the plugin
+        # machinery in the loop.
+
+        item_index = self.item_index
+        records = self.items
+        hot_index = self.hot_index
 
         for i in items:
-            try:
-                item_cache, item_idx = self.lookup_by_id(i)
-            except:
+            if i not in item_index:
                 continue
 
-            # NOTE: This relies on self.items maintaining
-            # the identical order to the entries on disk.
-            # Must be enforced by self.index()
+            item = records[item_index[i]]
+            updates[item.raw_id] = attributes[i]
 
-            for a in attributes[i]:
-                d["entries"][item_idx][a] = attributes[i][a]
+            # Items kept past their expiry for being unread can go once
+            # they've been read.
+
+            if i in self.expiring and "canto-state" in attributes[i] and\
+                    "read" in attributes[i]["canto-state"]:
+                expiry.schedule(i, self.expiring[i])
+
+            # Keep self.items up to date.
+
+            if item.hot != None:
+                for attr in attributes[i]:
+                    if attr in hot_index:
+                        item.hot[hot_index[attr]] = attributes[i][attr]
 
-        self.shelf[self.URL] = d
+        # Let the storage engine write only the items that changed.
+
+        self.shelf.update_items(self.URL, updates)
+        self.generation += 1
 
         # Allow DaemonFeed plugins to define set_attribute_* functions
         # to receive notifications of changed attributes
 
+        d = None
+
         for attr in list(self.plugin_attrs.keys()):
             if not attr.startswith("set_attributes_"):
                 continue
 
+            # Only pull the full content if someone wants it.
+
+            if d == None:
+                d = self.shelf[self.URL]
+
             try:
                 a = getattr(self, attr)
                 a(feed = self, items = items, attributes = attributes, content = d)
@@ -220,165 +769,457 @@ class CantoFeed(PluginHandler):
                 log.error("Error running feed set_attr plugin")
                 log.error(traceback.format_exc())
 
+    # Remove expired items from the feed, unless we're keeping unread items
+    # and they haven't been read. Those stay in self.expiring until they are.
+    # Returns the number of items removed.
+
+    def expire(self, handles):
+        if self.keep_unread:
+            state = self.get_attributes(handles,\
+                    dict([ (h, [ "canto-state" ]) for h in handles ]))
+            handles = [ h for h in handles if h in state and\
+                    "read" in state[h]["canto-state"] ]
+
+        if not handles:
+            return 0
+
+        gone = set(handles)
+        raw_ids = [ allitems[h].raw_id for h in handles ]
+
+        log.debug("Expiring %d items from %s" % (len(handles), self.URL))
+
+        olditems = self.items
+        self.items = []
+        self.item_index = {}
+        self.raw_ids = set()
+
+        for item in olditems:
+            if item.handle not in gone:
+                self.add_item(item)
+
+        for h in handles:
+            del self.expiring[h]
+
+        self.shelf.remove_items(self.URL, raw_ids)
+        for raw_id in raw_ids:
+            key = cold_key(self.URL, raw_id)
+            if key in self.shelf:
+                del self.shelf[key]
+
+        self.write_summary([ i.raw_id for i in self.items ])
+        self.generation += 1
+        self.clear_tags(olditems)
+        return len(handles)
+
+    # Strip the given entries down to the attributes we want to keep, moving
+    # any cold attributes out. Returns { feed ID : cold record } to write.
+
+    def project(self, entries):
+        colds = {}
+        for entry in entries:
+            cold = {}
+            for attr in list(entry.keys()):
+                # Never touch the ID or our own attributes.
+                if attr == "id" or attr.startswith("canto"):
+                    continue
+
+                if self.store_attributes and\
+                        not match_any(attr, self.store_attributes):
+                    del entry[attr]
+                elif match_any(attr, self.drop_attributes):
+                    del entry[attr]
+                elif match_any(attr, self.cold_attributes):
+                    cold[attr] = entry[attr]
+                    del entry[attr]
+
+            # Entries from disk have already been projected, so only replace
+            # the cold record if we have new content.
+
+            if cold:
+                colds[entry["id"]] = cold
+                entry["canto_cold"] = list(cold.keys())
+        return colds
+
     # Re-index contents
     # If we have self.update_contents, use that
     # If not, at least populate self.items from disk.
 
-    # MUST GUARANTEE self.items is in same order as entries on disk.
-
     def index(self):
+        contents = self.update_contents
+        self.update_contents = None
 
-        if not self.update_contents:
-            if self.URL in self.shelf:
-                self.update_contents = self.shelf[self.URL]
+        # Lazy feeds have to be checked against the disk before anything new
+        # can be merged in.
 
-            # If we got nothing, and there's not anything already resident, at
-            # least stub it in the shelf.
+        if contents != None and not self.hydrated:
+            self.hydrate()
 
-            else:
-                self.update_contents = {"entries" : []}
+        self.commit(self.merge(contents))
+
+    # Merge contents (or, if None, what's on disk) with the content on disk,
+    # and return a CantoMerged for commit(). This does the bulk of index(), but
+    # only reads the feed, so the fetch threads can do it for fetched feeds.
+    # The contents themselves are left alone.
+
+    # MUST GUARANTEE the merged entries line up with self.items as commit()
+    # will build it.
+
+    # Fresh entries are fingerprinted (canto_hash) so that entries that
+    # haven't changed since the last fetch are left exactly as they are on
+    # disk. Only new or changed entries are written and tagged, and if
+    # nothing changed at all, nothing is written.
+
+    def merge(self, contents):
+        merged = CantoMerged(self.generation, contents)
+        fresh = merged.fresh
 
         if self.URL not in self.shelf:
             # Stub empty feed
             log.debug("Previous content not found.")
             old_contents = {"entries" : []}
+            merged.stub = True
         else:
             old_contents = self.shelf[self.URL]
             log.debug("Fetched previous content.")
 
-        # BEWARE: At this point, update_contents could either be
-        # fresh from feedparser or fresh from disk, so it's possible that the
+        # If we got nothing, use what's on disk. It's possible that the
         # old contents and the new contents are identical.
 
+        if not contents:
+            contents = old_contents
+
+        old_entries = old_contents["entries"]
+
+        # { feed ID : old entry } for finding unchanged items and moving over
+        # custom content.
+
+        old_by_id = {}
+        for olditem in old_entries:
+            if "id" in olditem:
+                old_by_id[olditem["id"]] = olditem
+
         olditems = self.items
-        self.items = []
-        for item in self.update_contents["entries"][:]:
 
-            # Update canto_update only for freshly seen items.
-            item["canto_update"] = self.update_contents["canto_update"]
+        # The new document. Entries that are changed are copied first, since
+        # the old ones may be shared with the shelf's cache. The shelf never
+        # changes cached documents in place (see CantoShelf.update_items), so
+        # they can be read here while the main thread goes on using the feed.
+
+        doc = dict(contents)
+        entries = []
+        raw_ids = set()
+
+        changed = merged.changed
+        replaced = {}
+
+        for item in contents["entries"]:
 
             # Attempt to isolate a feed unique ID
             if "id" not in item:
+                item = dict(item)
                 if "link" in item:
                     item["id"] = item["link"]
                 elif "title" in item:
                     item["id"] = item["title"]
                 else:
                     log.error("Unable to uniquely ID item: %s" % item)
-                    self.update_contents["entries"].remove(item)
                     continue
 
             # Ensure ID truly is feed (and thus globally, since the
             # ID is paired with the unique URL) unique.
 
-            if not self.unique_item(item):
-                self.update_contents["entries"].remove(item)
+            if item["id"] in raw_ids:
                 continue
 
-            # At this point, we're sure item's going to be added.
+            if fresh:
+                h = fingerprint(item)
+
+                olditem = None
+                if item["id"] in old_by_id:
+                    olditem = old_by_id[item["id"]]
+
+                # Unchanged and still in the feed, keep what's on disk.
 
-            cacheitem = {}
-            cacheitem["id"] = json.dumps(\
-                    { "URL" : self.URL, "ID" : item["id"] } )
+                if olditem and "canto_hash" in olditem and\
+                        olditem["canto_hash"] == h and\
+                        "canto_in_feed" in olditem and\
+                        olditem["canto_in_feed"]:
+                    item = olditem
+                else:
+                    item = dict(item)
+
+                    # Update canto_update only for freshly seen items.
+                    item["canto_update"] = contents["canto_update"]
+                    item["canto_hash"] = h
+                    item["canto_in_feed"] = True
 
-            alltags.add_tag(cacheitem["id"], self.name, "maintag")
+                    # Move over custom content from item.
+                    # Custom content is denoted with a key that
+                    # starts with "canto", but not the keys we
+                    # maintain ourselves.
 
-            # Move over custom content from item.
-            # Custom content is denoted with a key that
-            # starts with "canto", but not "canto_update",
-            # which changes invariably.
+                    if olditem:
+                        for key in olditem:
+                            if key in ["canto_update", "canto_hash",\
+                                    "canto_in_feed"]:
+                                continue
+                            elif key.startswith("canto"):
+                                item[key] = olditem[key]
 
-            for olditem in old_contents["entries"]:
-                if item["id"] == olditem["id"]:
-                    for key in olditem:
-                        if key == "canto_update":
-                            continue
-                        elif key.startswith("canto"):
-                            item[key] = olditem[key]
+                        replaced[item["id"]] = olditem
 
-            # Other cache-able values should be added here.
+                    changed.add(item["id"])
 
-            self.items.append(cacheitem)
+            # At this point, we're sure item's going to be added.
 
-        # Keep items that have been given to clients from
-        # disappearing from the disk. This ensures that even if
-        # an item has been sitting in an active client for days
-        # requests for more information won't fail.
+            raw_ids.add(item["id"])
+            entries.append(item)
 
-        # While we're looping through the olditems, we also make a list of
-        # unprotected items for the next step (increasing the number of
-        # remembered feed items).
+        merged.in_feed = len(entries)
 
-        unprotected_old = []
+        # Items that have dropped out of the feed are kept until they expire
+        # (see CantoExpiry), so they're carried over as-is. This also keeps
+        # items that have been given to clients from disappearing from the
+        # disk, so requests for more information won't fail.
 
-        for i, olditem in enumerate(olditems):
-            for item in self.items:
-                if olditem["id"] == item["id"]:
-                    log.debug("still in self.items")
+        for i in range(len(olditems)):
+            entry = old_entries[i]
+            if entry["id"] in raw_ids:
+                log.debug("still in self.items")
+                continue
+
+            # If this just dropped out of the feed, it was last seen at the
+            # previous successful fetch. That's self.last_update, not the
+            # canto_update on disk, which isn't rewritten when a fetch finds
+            # nothing new (see touch()). Entries from before we tracked this
+            # have canto_update from the last fetch they were in.
+
+            if fresh and ("canto_in_feed" not in entry or\
+                    entry["canto_in_feed"]):
+                entry = dict(entry)
+                if "canto_in_feed" in entry:
+                    if self.last_update:
+                        entry["canto_update"] = self.last_update
+                    elif "canto_update" in old_contents:
+                        entry["canto_update"] = old_contents["canto_update"]
+                entry["canto_in_feed"] = False
+                changed.add(entry["id"])
+
+            if "canto_update" not in entry:
+                entry = dict(entry)
+                entry["canto_update"] = time.time()
+                changed.add(entry["id"])
+                log.debug("Subbing item time %s" % entry["id"])
+
+            raw_ids.add(entry["id"])
+            entries.append(entry)
+            merged.carried.append(i)
+
+        doc["entries"] = entries
+        merged.doc = doc
+
+        merged.removed = [ old_by_id[i] for i in old_by_id if i not in raw_ids ]
+
+        # Figure out whether anything other than the timestamp changed. If
+        # not, we're done. The new timestamp is kept in self.last_update.
+
+        dirty = merged.stub or changed or merged.removed
+
+        if fresh and not dirty:
+            h = fingerprint(doc)
+            if "canto_hash" not in old_contents or\
+                    old_contents["canto_hash"] != h:
+                dirty = True
+
+        if not dirty and len(entries) == len(old_entries):
+            for new, old in zip(entries, old_entries):
+                if new is not old:
+                    dirty = True
                     break
-            else:
-                if protection.protected(olditem["id"]):
-                    log.debug("Saving committed item: %s" % olditem)
-                    self.items.append(olditem)
-                    self.update_contents["entries"].append(\
-                            old_contents["entries"][i])
-                else:
-                    unprotected_old.append((i, olditem))
+        else:
+            dirty = True
 
-        # Keep all items that have been seen in the feed in the last day.
+        merged.dirty = dirty
 
-        ref_time = time.time()
-        for idx, item in unprotected_old:
-            # Old item
-            if "canto_update" not in old_contents["entries"][idx]:
-                old_contents["entries"][idx]["canto_update"] = ref_time
-                log.debug("Subbing item time %s" % item)
+        if dirty:
+            if fresh:
+                doc["canto_hash"] = fingerprint(doc)
 
-            item_time = old_contents["entries"][idx]["canto_update"]
-            if "canto-state" in old_contents["entries"][idx]:
-                item_state = old_contents["entries"][idx]["canto-state"]
-            else:
-                item_state = []
+            log.debug("%s: %d changed, %d removed" %\
+                    (self.URL, len(changed), len(merged.removed)))
+
+            # Allow plugins DaemonFeedPlugins defining edit_* functions to
+            # have a crack at the contents before we commit to disk. They're
+            # only given the new or changed entries, since those are the only
+            # ones written out. The rest are still the shelf's cached ones.
+
+            editors = [ attr for attr in list(self.plugin_attrs.keys())\
+                    if attr.startswith("edit_") ]
+
+            if editors:
+                positions = {}
+                for i, entry in enumerate(entries):
+                    if entry["id"] in changed:
+                        positions[entry["id"]] = i
+
+                doc["entries"] = [ entries[i] for i in positions.values() ]
+
+                for attr in editors:
+                    try:
+                        a = getattr(self, attr)
+                        a(feed = self, newcontent = doc)
+                    except:
+                        log.error("Error running feed editing plugin")
+                        log.error(traceback.format_exc())
+
+                # Plugins may have replaced entries outright.
+
+                for entry in doc["entries"]:
+                    if "id" in entry and entry["id"] in positions:
+                        entries[positions[entry["id"]]] = entry
+                doc["entries"] = entries
+
+            merged.cold = self.project([ e for e in entries\
+                    if e["id"] in changed ])
+
+        for entry in entries:
+            merged.hot.append(self.hot_values(entry))
+
+            # Let tag watchers know which attributes changed. Cold
+            # attributes aren't loaded to compare, so assume they did.
+
+            if dirty and entry["id"] in replaced:
+                olditem = replaced[entry["id"]]
+                attrs = [ k for k in entry if not k.startswith("canto") and\
+                        (k not in olditem or olditem[k] != entry[k]) ]
+                attrs += [ k for k in olditem if not k.startswith("canto")\
+                        and k not in entry ]
+                if "canto_cold" in entry:
+                    attrs += entry["canto_cold"]
+                if attrs:
+                    merged.attrs[entry["id"]] = attrs
+
+        return merged
+
+    # Swap in a merge, updating self.items, the tags and the disk. This is
+    # what's left of index() for the main thread. The merge must have been
+    # started at the current generation, or self.items won't line up with it.
+
+    def commit(self, merged):
+        self.hydrated = True
+
+        olditems = self.items
+        old_index = self.item_index
+
+        doc = merged.doc
+        entries = doc["entries"]
+
+        # Build the lists directly rather than going through add_item, this
+        # is the bulk of what's left for the main thread.
 
-            if (ref_time - item_time) < self.keep_time:
-                log.debug("Item not over keep_time (%d): %s" %
-                        (self.keep_time, item))
-            elif self.keep_unread and "read" not in item_state:
-                log.debug("Keeping unread item: %s\n" % item)
+        name = self.name
+        hot = merged.hot
+        attrs = merged.attrs
+        carried = merged.carried
+        in_feed = merged.in_feed
+
+        items = []
+        item_index = {}
+
+        for i, entry in enumerate(entries):
+            if i < in_feed:
+                record = allitems.register(self, entry["id"])
+                if record.handle not in old_index:
+                    alltags.add_tag(record.handle, name, "maintag")
             else:
-                log.debug("Discarding: %s", item)
-                continue
+                record = olditems[carried[i - in_feed]]
 
-            self.update_contents["entries"].append(\
-                    old_contents["entries"][idx])
-            self.items.append(item)
+            record.hot = hot[i]
+            item_index[record.handle] = len(items)
+            items.append(record)
 
-        # Allow plugins DaemonFeedPlugins defining edit_* functions to have a
-        # crack at the contents before we commit to disk.
+            if entry["id"] in attrs:
+                alltags.items_changed([ record.handle ], attrs[entry["id"]])
 
-        for attr in list(self.plugin_attrs.keys()):
-            if not attr.startswith("edit_"):
+        self.items = items
+        self.item_index = item_index
+        self.raw_ids = set([ e["id"] for e in entries ])
+
+        # Schedule anything out of the feed to expire keep_time after it was
+        # last seen, which merge() has put in its canto_update. Expiry times
+        # already known are kept as they are, since the item may be waiting
+        # to be read or unprotected.
+
+        expiring = {}
+        for item, entry in zip(self.items, entries):
+            if "canto_in_feed" not in entry or entry["canto_in_feed"]:
                 continue
 
-            try:
-                a = getattr(self, attr)
-                a(feed = self, newcontent = self.update_contents)
-            except:
-                log.error("Error running feed editing plugin")
-                log.error(traceback.format_exc())
+            if item.handle in self.expiring:
+                expiring[item.handle] = self.expiring[item.handle]
+            else:
+                when = entry["canto_update"] + self.keep_time
+                expiring[item.handle] = when
+                expiry.schedule(item.handle, when)
+
+        self.expiring = expiring
+
+        # A lazy feed's summary may have a later update time than its content
+        # on disk, so never go backwards.
+
+        if "canto_update" in doc:
+            self.last_update = max(self.last_update, doc["canto_update"])
+
+        # Fresh content carries the validators it was fetched with.
+
+        if merged.fresh:
+            validators = {}
+            for key in VALIDATORS:
+                if key in doc:
+                    validators[key] = doc[key]
+            self.validators = validators
+
+        if merged.fresh or merged.dirty or\
+                summary_key(self.URL) not in self.shelf:
+            self.write_summary([ e["id"] for e in entries ])
+
+        self.generation += 1
+
+        if not merged.dirty:
+            log.debug("%s unchanged, skipping commit." % self.URL)
+            self.clear_tags(olditems)
+            return
+
+        for raw_id, cold in merged.cold.items():
+            self.shelf[cold_key(self.URL, raw_id)] = cold
+
+        for entry in merged.removed:
+            if "canto_cold" in entry:
+                key = cold_key(self.URL, entry["id"])
+                if key in self.shelf:
+                    del self.shelf[key]
 
         # Commit the updates to disk.
-        self.shelf[self.URL] = self.update_contents
+        self.shelf.write_feed(self.URL, doc, merged.changed)
 
         # Remove non-existent IDs from all tags
         self.clear_tags(olditems)
 
-        # No more updates
-        self.update_contents = None
-
     def destroy(self):
         # Check for existence in case of delete quickly
         # after add.
 
         if self.URL in self.shelf:
+            for entry in self.shelf[self.URL]["entries"]:
+                key = cold_key(self.URL, entry["id"])
+                if "canto_cold" in entry and key in self.shelf:
+                    del self.shelf[key]
+
             del self.shelf[self.URL]
+
+        if summary_key(self.URL) in self.shelf:
+            del self.shelf[summary_key(self.URL)]
+
+        for item in self.items:
+            if item.feed is self:
+                allitems.release(item.handle)
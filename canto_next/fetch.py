@@ -6,27 +6,222 @@
 #   it under the terms of the GNU General Public License version 2 as 
 #   published by the Free Software Foundation.
 
+from .asyncfetch import CantoAsyncFetch, CantoHTTPError, FetchError,\
+        decompress
 from .plugins import PluginHandler, Plugin
-from .feed import allfeeds
+from .feed import allfeeds, new_health
+from .hooks import on_hook
 
-from threading import Thread
+from threading import Thread, Condition, Lock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 import feedparser
 import traceback
+import hashlib
 import urllib.parse
 import urllib.request, urllib.error, urllib.parse
+import fnmatch
 import logging
+import random
+import heapq
 import time
 
 log = logging.getLogger("CANTO-FETCH")
 
+# Default seconds to wait on a server before giving up, so that a dead host
+# can't tie up a fetch thread indefinitely, and the default limit on the size
+# of a feed.
+
+FETCH_TIMEOUT = 60
+FETCH_MAX_SIZE = 8 * 1024 * 1024
+
+# Feeds are fetched up to this fraction of their rate late, at random, so that
+# feeds with the same rate spread out instead of all being fetched at once.
+
+FETCH_JITTER = 0.1
+
+# Minimum seconds between fetches of a feed, so one that keeps failing (and so
+# never gets a new update time) isn't refetched in a tight loop.
+
+FETCH_RETRY = 60
+
+# Times a merge that went stale before it could be committed is redone in the
+# fetch threads, before giving up and indexing on the main thread.
+
+MERGE_RETRIES = 3
+
+# Feeds that fail are retried after FETCH_RETRY seconds, doubling with each
+# consecutive failure, up to BACKOFF_MAX. After BREAKER_THRESHOLD failures in a
+# row, the feed's circuit breaker opens, and it's only tried once every
+# BACKOFF_MAX until a fetch succeeds.
+
+BACKOFF_MAX = 6 * 60 * 60
+BREAKER_THRESHOLD = 5
+
 class DaemonFetchThreadPlugin(Plugin):
     pass
 
+# Convert feedparser's FeedParserDicts into plain dicts and lists, so that
+# results can be sent back from a parse process, and stored.
+
+def plain(obj):
+    if isinstance(obj, dict):
+        return dict([ (k, plain(v)) for k, v in obj.items() ])
+    if isinstance(obj, list):
+        return [ plain(v) for v in obj ]
+    return obj
+
+# Parse a downloaded feed. This runs in the parse pool, possibly in another
+# process, so it only deals in picklable values. The bozo_exception, if any,
+# is reduced to its message.
+
+def parse_feed(body, headers):
+    result = feedparser.parse(body, response_headers = headers)
+    if "bozo_exception" in result:
+        result["bozo_exception"] = str(result["bozo_exception"])
+    return plain(result)
+
+# Return the host a URL is fetched from, for the purposes of limiting how
+# often, and how many at once, we make requests to it.
+
+def feed_host(URL):
+    return urllib.parse.urlparse(URL)[1].lower()
+
+# A request that a DaemonFetchThreadPlugin wants made on behalf of a feed. It
+# waits in CantoFetch until the politeness limits allow it, and then a fetch
+# thread downloads it and calls callback with (status, headers, body, URL), or
+# None if it failed.
+
+class CantoRequest():
+    def __init__(self, feed, URL, headers, callback):
+        self.feed = feed
+        self.URL = URL
+        self.host = feed_host(URL)
+        self.headers = headers
+        self.callback = callback
+
+# A fetched feed to be merged with its content on disk, so that all the main
+# thread has to do is commit it.
+
+class CantoMerge():
+    def __init__(self, feed, tries = 0):
+        self.feed = feed
+        self.tries = tries
+
+# Daemon wide limits on how often we make requests to each host. Each host
+# matching a pattern gets a token bucket that holds up to burst tokens and
+# gains one every interval seconds, and each request takes a token. Hosts that
+# don't match any pattern aren't limited.
+
+# Nothing waits on a bucket. Feeds and plugin requests are just left queued in
+# CantoFetch until their host has a token, and fetch threads do other work in
+# the meantime.
+
+class CantoPoliteness():
+    def __init__(self):
+        self.lock = Lock()
+
+        # [ (pattern, interval, burst) ] from the config, and defaults
+        # plugins have set, which the config overrides.
+
+        self.rates = []
+        self.defaults = []
+
+        # { host : (interval, burst) or None }
+        self.rules = {}
+
+        # { host : [ tokens, time of last refill ] }
+        self.buckets = {}
+
+        # The CantoFetch that plugin requests go through.
+        self.pool = None
+
+        self.throttled = 0
+
+    # Rates are { pattern : { "interval" : seconds, "burst" : requests } }
+    # with burst optional.
+
+    def configure(self, rates):
+        with self.lock:
+            self.rates = []
+            for pattern in sorted(rates.keys()):
+                rate = rates[pattern]
+                self.rates.append((pattern.lower(), rate["interval"],
+                        rate.get("burst", 1)))
+            self.rules = {}
+
+    def set_default(self, pattern, interval, burst = 1):
+        with self.lock:
+            self.defaults.append((pattern.lower(), interval, burst))
+            self.rules = {}
+
+    # Patterns match the host name, without any port.
+
+    def rule(self, host):
+        if host not in self.rules:
+            self.rules[host] = None
+            name = urllib.parse.urlsplit("//" + host).hostname or host
+            for pattern, interval, burst in self.rates + self.defaults:
+                if fnmatch.fnmatch(name, pattern):
+                    self.rules[host] = (interval, burst)
+                    break
+        return self.rules[host]
+
+    # Take a token for a request to host. Return 0 if we got one, otherwise the
+    # number of seconds until there will be one.
+
+    def take(self, host):
+        with self.lock:
+            rule = self.rule(host)
+            if not rule:
+                return 0
+
+            interval, burst = rule
+            now = time.time()
+
+            if host not in self.buckets:
+                self.buckets[host] = [ burst, now ]
+            bucket = self.buckets[host]
+
+            if interval > 0:
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) / interval)
+            else:
+                bucket[0] = burst
+            bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+
+            self.throttled += 1
+            return (1 - bucket[0]) * interval
+
+    # For DaemonFetchThreadPlugins. Queue a request for URL on behalf of feed,
+    # and call callback with the response when it's done. The feed won't be
+    # indexed until all of its requests (including any that callbacks make)
+    # are done.
+
+    def request(self, feed, URL, callback, headers = None):
+        if not headers:
+            headers = { 'User-Agent' :\
+                    'Canto/0.8.0 + http://codezen.org/canto' }
+        self.pool.add_request(CantoRequest(feed, URL, headers, callback))
+
+    def stats(self):
+        with self.lock:
+            return { "hosts" : len(self.buckets),
+                     "throttled" : self.throttled }
+
+politeness = CantoPoliteness()
+
 # This is the first time I've ever had a need for multiple inheritance.
 # I'm not sure if that's a good thing or not =)
 
+# Fetch threads are long lived workers in CantoFetch's pool, each taking feeds
+# and plugin requests off of the queue and handling them one at a time.
+
 class CantoFetchThread(PluginHandler, Thread):
-    def __init__(self, feed):
+    def __init__(self, fetch):
         PluginHandler.__init__(self)
         Thread.__init__(self)
         self.daemon = True
@@ -34,41 +229,222 @@ class CantoFetchThread(PluginHandler, Thread):
         self.plugin_class = DaemonFetchThreadPlugin
         self.update_plugin_lookups()
 
-        self.feed = feed
+        self.fetch = fetch
+        self.feed = None
+        self.error = None
 
     def run(self):
-        extra_headers = { 'User-Agent' :\
-                'Canto/0.8.0 + http://codezen.org/canto' }
+        while True:
+            job = self.fetch.next_job(self)
+            if not job:
+                return
+
+            start = time.time()
+
+            if isinstance(job, CantoRequest):
+                self.run_request(job)
+                self.fetch.request_done(job, time.time() - start)
+                continue
+
+            if isinstance(job, CantoMerge):
+                self.run_merge(job)
+                self.fetch.merge_done(job.feed, time.time() - start)
+                continue
+
+            feed = job
+            self.feed = feed
+            self.error = None
+            touched = None
+            try:
+                touched = self.fetch_feed()
+            except Exception as e:
+                log.error("Error fetching %s" % feed.URL)
+                log.error(traceback.format_exc())
+                self.feed.update_contents = None
+                self.error = "%s" % e
+            self.feed = None
+
+            self.fetch.feed_done(feed, time.time() - start, touched,
+                    self.error)
+
+    # Download the feed, returning the status, the response headers (with
+    # lowercase names, as feedparser expects), the decompressed body, and the
+    # URL it came from after any redirects.
+
+    def download(self, validators):
+        headers = { 'User-Agent' : 'Canto/0.8.0 + http://codezen.org/canto',
+                    'Accept-encoding' : 'gzip, deflate' }
+
+        if "canto_etag" in validators and validators["canto_etag"]:
+            headers["If-None-Match"] = validators["canto_etag"]
+        if "canto_modified" in validators and validators["canto_modified"]:
+            headers["If-Modified-Since"] = validators["canto_modified"]
+
+        return self.get(self.feed.URL, headers, self.feed.username,
+                self.feed.password)
+
+    def run_request(self, request):
+        try:
+            response = self.get(request.URL, request.headers)
+        except Exception as e:
+            log.error("ERROR: couldn't grab %s : %s" % (request.URL, e))
+            response = None
+
+        try:
+            request.callback(response)
+        except:
+            log.error("Error running fetch thread plugin request callback")
+            log.error(traceback.format_exc())
+
+    # Merge a fetched feed into feed.merged, for process() to commit. Lazy
+    # feeds that haven't been hydrated yet are left for index(), since
+    # hydrating changes the feed. If the merge fails, index() gets to try.
+
+    def run_merge(self, job):
+        feed = job.feed
+        if not feed.hydrated or feed.update_contents == None:
+            return
+
+        try:
+            merged = feed.merge(feed.update_contents)
+            merged.tries = job.tries
+            feed.merged = merged
+            feed.update_contents = None
+        except:
+            log.error("Error merging %s" % feed.URL)
+            log.error(traceback.format_exc())
+
+    # Download URL, with the async engine if it's enabled.
+
+    def get(self, URL, headers, username = None, password = None):
+        engine = self.fetch.use_engine()
+        if engine:
+            try:
+                return engine.download(URL, headers, username, password)
+            except CantoHTTPError as e:
+                # The async engine only does basic auth, so leave anything
+                # else to urllib.
+
+                if e.status != 401 or not (username or password):
+                    raise
+            finally:
+                self.fetch.release_engine(engine)
+
+        return self.download_urllib(URL, headers, username, password)
+
+    def download_urllib(self, URL, headers, username, password):
+        timeout = self.fetch.timeout
+        max_size = self.fetch.max_size
+
+        request = urllib.request.Request(URL, headers = headers)
 
         try:
-            result = None
             # Passworded Feed
-            if self.feed.username or self.feed.password:
-                domain = urllib.parse.urlparse(self.feed.URL)[1]
+            if username or password:
+                domain = urllib.parse.urlparse(URL)[1]
                 auth = urllib.request.HTTPBasicAuthHandler()
-                auth.add_password(None, domain, self.feed.username,
-                        self.feed.password)
+                auth.add_password(None, domain, username, password)
 
                 try:
-                    result = feedparser.parse(self.feed.URL, handlers=[auth],
-                            request_headers = extra_headers)
-                except:
+                    response = urllib.request.build_opener(auth).open(request,
+                            timeout = timeout)
+                except urllib.error.HTTPError as e:
+                    if e.code == 304:
+                        raise
+
                     # And, failing that, Digest Authentication
                     auth = urllib.request.HTTPDigestAuthHandler()
-                    auth.add_password(None, domain, self.feed.username,
-                            self.feed.password)
-                    result = feedparser.parse(self.feed.URL, handlers=[auth],
-                            request_headers = extra_headers)
+                    auth.add_password(None, domain, username, password)
+                    response = urllib.request.build_opener(auth).open(request,
+                            timeout = timeout)
 
             # No password
             else:
-                result = feedparser.parse(self.feed.URL,
-                        request_headers = extra_headers)
+                response = urllib.request.urlopen(request, timeout = timeout)
+
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            headers = dict([ (k.lower(), v) for k, v in e.headers.items() ])
+            return (304, headers, b"", URL)
+
+        headers = dict([ (k.lower(), v) for k, v in response.headers.items() ])
+        body = response.read(max_size + 1)
+        response.close()
+
+        if len(body) > max_size:
+            raise FetchError("Body too large")
+
+        body = decompress(headers, body, max_size)
+        return (response.status, headers, body, response.geturl())
+
+    # Fetch and parse self.feed into its update_contents. If the server says
+    # the feed hasn't been modified since we last got it, or sends exactly
+    # what it sent last time, there's nothing to parse, and we instead return
+    # the new timestamp and cache validators for CantoFeed.touch(). If the
+    # fetch fails, self.error is set.
+
+    def fetch_feed(self):
+        validators = self.feed.validators
+
+        try:
+            status, headers, body, href = self.download(validators)
+        except Exception as e:
+            log.error("ERROR: couldn't grab %s : %s" % (self.feed.URL, e))
+            self.feed.update_contents = None
+            self.error = "Couldn't grab: %s" % e
+            return
+
+        # Remember the validators for next time, whether or not the feed has
+        # been modified.
 
+        touched = { "canto_update" : time.time() }
+        if "etag" in headers:
+            touched["canto_etag"] = headers["etag"]
+        if "last-modified" in headers:
+            touched["canto_modified"] = headers["last-modified"]
+
+        if status == 304:
+            log.debug("%s not modified." % self.feed.URL)
+            self.feed.update_contents = None
+
+            # Keep any validators the server didn't bother to repeat.
+
+            for key in validators:
+                if key not in touched:
+                    touched[key] = validators[key]
+
+            touched["canto_unchanged"] = "not_modified"
+            return touched
+
+        touched["canto_length"] = len(body)
+        touched["canto_digest"] = hashlib.sha1(body).hexdigest()
+
+        # Plenty of servers ignore conditional requests, but if we got exactly
+        # the same bytes as last time, parsing them would get us nowhere.
+
+        if "canto_digest" in validators and\
+                validators["canto_digest"] == touched["canto_digest"]:
+            log.debug("%s identical to last fetch." % self.feed.URL)
+            self.feed.update_contents = None
+            touched["canto_unchanged"] = "identical"
+            return touched
+
+        # Let feedparser resolve relative links against where the feed
+        # actually came from.
+
+        if "content-location" not in headers:
+            headers["content-location"] = href
+
+        try:
+            result = self.fetch.parse(body, headers)
+            result["href"] = href
+            result["status"] = status
             self.feed.update_contents = result
         except Exception as e:
             log.error("ERROR: try to parse %s, got %s" % (self.feed.URL, e))
             self.feed.update_contents = None
+            self.error = "Couldn't parse: %s" % e
             return
 
         # Interpret feedparser's bozo_exception, if there was an
@@ -76,26 +452,21 @@ class CantoFetchThread(PluginHandler, Thread):
         # any other broken feed.
 
         if "bozo_exception" in self.feed.update_contents:
-            if self.feed.update_contents["bozo_exception"] == urllib.error.URLError:
-                log.error("ERROR: couldn't grab %s : %s" %\
-                        (self.feed.URL,\
-                        self.feed.update_contents["bozo_exception"].reason))
-                self.feed.update_contents = None
-                return
-            elif len(self.feed.update_contents["entries"]) == 0:
+            if len(self.feed.update_contents["entries"]) == 0:
                 log.error("No content in %s: %s" %\
                         (self.feed.URL,\
                         self.feed.update_contents["bozo_exception"]))
+                self.error = "No content: %s" %\
+                        self.feed.update_contents["bozo_exception"]
                 self.feed.update_contents = None
                 return
 
-            # Replace it if we ignore it, since exceptions
-            # are not pickle-able.
+            # Replace it if we ignore it.
 
             self.feed.update_contents["bozo_exception"] = None
 
-        # Update timestamp
-        self.feed.update_contents["canto_update"] = time.time()
+        # Update timestamp and validators
+        self.feed.update_contents.update(touched)
 
         log.debug("Parsed %s" % self.feed.URL)
 
@@ -115,65 +486,605 @@ class CantoFetchThread(PluginHandler, Thread):
 
         log.debug("Plugins complete.")
 
+# CantoFetch keeps a fixed number of fetch threads, no matter how many feeds
+# are due, and at most host_threads of them on any one host. Feeds that are due
+# wait in a queue, along with requests from plugins, until a thread is free and
+# politeness allows, and are handed to the main thread to be indexed as they
+# finish.
+
+# Fetch threads download with urllib, or, in "async" engine mode, through a
+# CantoAsyncFetch that keeps connections to each host alive between fetches.
+# Either way, they hand what they download to a separate parse pool. In "thread"
+# mode, the default, it's just a limit on how many fetch threads parse at once.
+# In "process" mode, that's parse_workers processes, so parsing isn't
+# serialized on the GIL with everything else in the daemon, at the cost of a
+# Python interpreter per worker.
+
 class CantoFetch():
-    def __init__(self, shelf):
+    def __init__(self, shelf, threads = 8, host_threads = 2,
+            parse_workers = 1, parse_mode = "thread", engine = "urllib",
+            timeout = FETCH_TIMEOUT, max_size = FETCH_MAX_SIZE,
+            host_rates = {}):
         self.shelf = shelf
-        self.threads = []
 
-    def needs_update(self, feed):
+        politeness.pool = self
+
+        # The async engine, if it's enabled, and { engine : count } of the
+        # fetch threads using each engine. An engine that's been switched off
+        # is stopped once nothing is using it.
+
+        self.engine = None
+        self.engine_users = {}
+
+        self.timeout = timeout
+        self.max_size = max_size
+
+        # Heap of (due time, URL), and { URL : due time }. Only used from the
+        # main thread.
+
+        self.schedule = []
+        self.scheduled = {}
+
+        self.parser = None
+        self.parse_workers = 0
+        self.parse_mode = None
+
+        # Everything below is shared with the fetch threads, and protected by
+        # self.cond.
+
+        self.cond = Condition()
+
+        self.workers = []
+        self.target = 0
+        self.host_threads = 1
+
+        # Feeds waiting on a thread, in order, and plugin requests.
+        self.queue = []
+        self.requests = []
+
+        # { URL : host } of feeds being fetched, and { host : count } of
+        # feeds and requests in progress.
+        self.working = {}
+        self.hosts = {}
+
+        # { feed URL : count } of plugin requests not yet done, and { feed URL
+        # : (touched, error) } of feeds that are fetched but waiting on them.
+        self.pending = {}
+        self.waiting = {}
+
+        # Fetched feeds waiting to be merged, and the URLs of those and the
+        # feeds being merged.
+        self.merges = []
+        self.merging = set()
+
+        # (URL, touched, error) of feeds fetched, waiting to be indexed.
+        self.done = []
+
+        # For utilisation, seconds spent fetching vs. the seconds worth of
+        # threads we've had around.
+
+        self.fetched = 0
+        self.parsed = 0
+        self.not_modified = 0
+        self.identical = 0
+        self.busy = 0.0
+        self.capacity = 0.0
+        self.capacity_since = time.time()
+
+        self.configure(threads, host_threads, parse_workers, parse_mode,
+                engine, timeout, max_size, host_rates)
+
+        on_hook("exit", self.stop)
+
+    def _account(self):
+        now = time.time()
+        self.capacity += len(self.workers) * (now - self.capacity_since)
+        self.capacity_since = now
+
+    # Set the size of the pool and the per host limit, and set up the parse
+    # pool and fetch engine. Extra threads exit after their current fetch, and
+    # parses already submitted to an old parse pool are finished.
+
+    def configure(self, threads, host_threads, parse_workers = 1,
+            parse_mode = "thread", engine = "urllib",
+            timeout = FETCH_TIMEOUT, max_size = FETCH_MAX_SIZE,
+            host_rates = {}):
+        threads = max(1, threads)
+        host_threads = max(1, host_threads)
+        parse_workers = max(1, parse_workers)
+
+        politeness.configure(host_rates)
+
+        with self.cond:
+            self.timeout = timeout
+            self.max_size = max_size
+
+            retired = None
+            if engine == "async":
+                if not self.engine:
+                    self.engine = CantoAsyncFetch()
+                    self.engine.start()
+                self.engine.configure(timeout, max_size)
+
+            # Threads may still be using the old engine, in which case the last
+            # of them stops it.
+
+            elif self.engine:
+                if not self.engine_users.get(self.engine, 0):
+                    retired = self.engine
+                self.engine = None
+
+            if parse_workers != self.parse_workers or\
+                    parse_mode != self.parse_mode:
+                if self.parser:
+                    self.parser.shutdown(wait = False)
+
+                # Don't fork the daemon, threads and all, to parse.
+
+                if parse_mode == "process":
+                    self.parser = ProcessPoolExecutor(parse_workers,
+                            multiprocessing.get_context("spawn"))
+                else:
+                    self.parser = ThreadPoolExecutor(parse_workers)
+
+                self.parse_workers = parse_workers
+                self.parse_mode = parse_mode
+
+            self._account()
+            self.target = threads
+            self.host_threads = host_threads
+
+            while len(self.workers) < self.target:
+                thread = CantoFetchThread(self)
+                self.workers.append(thread)
+                thread.start()
+
+            self.cond.notify_all()
+
+        if retired:
+            retired.stop()
+
+        log.debug("Fetching with %d threads, %d per host." %\
+                (threads, host_threads))
+        log.debug("Parsing with %d %s workers." % (parse_workers, parse_mode))
+        log.debug("Fetching with %s engine." % engine)
+
+    # Called from fetch threads, to get the engine to download with (or None
+    # for urllib) and give it back when they're done with it.
+
+    def use_engine(self):
+        with self.cond:
+            engine = self.engine
+            if engine:
+                self.engine_users[engine] =\
+                        self.engine_users.get(engine, 0) + 1
+            return engine
+
+    def release_engine(self, engine):
+        if not engine:
+            return
+
+        with self.cond:
+            self.engine_users[engine] -= 1
+            if self.engine_users[engine]:
+                return
+            del self.engine_users[engine]
+            if engine is self.engine:
+                return
+
+        engine.stop()
+
+    # Stop the async engine, and the parse pool, when the daemon exits.
+
+    def stop(self):
+        with self.cond:
+            engine = self.engine
+            self.engine = None
+            if engine and self.engine_users.get(engine, 0):
+                engine = None
+
+            parser = self.parser
+            self.parser = None
+            self.parse_workers = 0
+            self.parse_mode = None
+
+        if engine:
+            engine.stop()
+        if parser:
+            parser.shutdown(wait = False)
+
+    # Called from fetch threads. Parse a body in the parse pool, and wait for
+    # the result.
+
+    def parse(self, body, headers):
+        with self.cond:
+            future = self.parser.submit(parse_feed, body, headers)
+
+        result = future.result()
+
+        with self.cond:
+            self.parsed += 1
+        return result
+
+    # Called with self.cond held. Return the index of the first job in queue
+    # that can be started without exceeding the per host limit or politeness,
+    # or None. Hosts that can't be used are added to blocked, and the soonest a
+    # blocked host will have a token is returned in wait[0].
+
+    def _startable(self, queue, host_of, blocked, wait):
+        for i, job in enumerate(queue):
+            host = host_of(job)
+            if host in blocked:
+                continue
+
+            if self.hosts.get(host, 0) >= self.host_threads:
+                blocked.add(host)
+                continue
+
+            delay = politeness.take(host)
+            if delay:
+                blocked.add(host)
+                if wait[0] == None or delay < wait[0]:
+                    wait[0] = delay
+                continue
+
+            self.hosts[host] = self.hosts.get(host, 0) + 1
+            return i
+        return None
+
+    # Called from fetch threads. Block until there's a plugin request or feed
+    # we can fetch, or fetched feed to merge, and return it, or return None if
+    # the thread should exit. Requests come first, since they hold up feeds
+    # that are already fetched, then merges.
+
+    def next_job(self, thread):
+        with self.cond:
+            while True:
+                if len(self.workers) > self.target:
+                    self._account()
+                    self.workers.remove(thread)
+                    return None
+
+                blocked = set()
+                wait = [ None ]
+
+                i = self._startable(self.requests, lambda r : r.host,
+                        blocked, wait)
+                if i != None:
+                    return self.requests.pop(i)
+
+                if self.merges:
+                    return self.merges.pop(0)
+
+                i = self._startable(self.queue, lambda f : feed_host(f.URL),
+                        blocked, wait)
+                if i != None:
+                    feed = self.queue.pop(i)
+                    self.working[feed.URL] = feed_host(feed.URL)
+                    return feed
+
+                # Nothing to do until something finishes, more work comes in,
+                # or a host's bucket has a token again.
+
+                self.cond.wait(wait[0])
+
+    def add_request(self, request):
+        with self.cond:
+            URL = request.feed.URL
+            self.pending[URL] = self.pending.get(URL, 0) + 1
+            self.requests.append(request)
+            self.cond.notify_all()
+
+    # Called with self.cond held when a feed has been fetched, and any plugin
+    # requests for it are done. Anything that has to be indexed is merged
+    # first.
+
+    def _finished(self, feed, touched, error):
+        if touched or error:
+            self.done.append((feed.URL, touched, error))
+        else:
+            self.merging.add(feed.URL)
+            self.merges.append(CantoMerge(feed))
+
+    def _host_done(self, host):
+        self.hosts[host] -= 1
+        if not self.hosts[host]:
+            del self.hosts[host]
+
+    # Called from fetch threads when a plugin request is finished.
+
+    def request_done(self, request, elapsed):
+        with self.cond:
+            self._host_done(request.host)
+            self.busy += elapsed
+
+            URL = request.feed.URL
+            self.pending[URL] -= 1
+            if not self.pending[URL]:
+                del self.pending[URL]
+                if URL in self.waiting:
+                    touched, error = self.waiting.pop(URL)
+                    self._finished(request.feed, touched, error)
+
+            self.cond.notify_all()
+
+    # Called from fetch threads when a feed is finished, with what to touch()
+    # the feed with if it didn't need indexing, and the error if it failed.
+
+    def feed_done(self, feed, elapsed, touched, error = None):
+        with self.cond:
+            self._host_done(self.working.pop(feed.URL))
+
+            if feed.URL in self.pending:
+                self.waiting[feed.URL] = (touched, error)
+            else:
+                self._finished(feed, touched, error)
+            self.fetched += 1
+            if touched and touched["canto_unchanged"] == "not_modified":
+                self.not_modified += 1
+            elif touched:
+                self.identical += 1
+            self.busy += elapsed
+
+            # A slot opened up on this host.
+            self.cond.notify_all()
+
+    # Called from fetch threads when a feed has been merged.
+
+    def merge_done(self, feed, elapsed):
+        with self.cond:
+            self.merging.discard(feed.URL)
+            self.done.append((feed.URL, None, None))
+            self.busy += elapsed
+
+    # Return when a feed should next be fetched.
+
+    def next_due(self, feed):
         if not feed.items:
             log.info("Empty feed, attempt to update.")
-            return True
+            due = time.time()
 
-        needs_update = True
-        if feed.URL in self.shelf:
-            f = self.shelf[feed.URL]
+        # The feed keeps its last update time, which isn't necessarily on
+        # disk if the last fetch didn't change anything.
 
-            if "canto_update" not in f:
-                log.warn("No canto_update in feed w/ URL: %s" % feed.URL)
-                return True
+        elif not feed.last_update:
+            log.warn("No canto_update in feed w/ URL: %s" % feed.URL)
+            due = time.time()
+
+        else:
+            rate = feed.rate * 60
+            due = feed.last_update + rate +\
+                    random.uniform(0, rate * FETCH_JITTER)
+
+        # Failing feeds wait out their backoff.
+
+        return max(due, feed.health["next_retry"])
+
+    # Record a failed fetch in the feed's health, and back off.
+
+    def failed(self, feed, error):
+        now = time.time()
+
+        health = dict(feed.health)
+        health["failures"] += 1
+        health["last_error"] = error
+        health["last_failure"] = now
 
-            passed = time.time() - f["canto_update"]
-            if passed < feed.rate * 60:
-                log.debug("Not enough time passed on %s (only %sm)" %
-                        (feed.URL, passed / 60))
-                needs_update = False
+        failures = health["failures"]
+        delay = min(FETCH_RETRY * 2 ** min(failures - 1, 16), BACKOFF_MAX)
 
-        return needs_update
+        if failures >= BREAKER_THRESHOLD:
+            if health["state"] != "open":
+                log.warn("%s failed %d times in a row, only retrying every"
+                        " %d seconds." % (feed.URL, failures, BACKOFF_MAX))
+            health["state"] = "open"
+            delay = BACKOFF_MAX
+        else:
+            health["state"] = "closed"
+
+        health["next_retry"] = now + delay * random.uniform(1, 1 + FETCH_JITTER)
+        feed.set_health(health)
+
+    def succeeded(self, feed):
+        if feed.health["failures"] or feed.health["state"] != "closed":
+            log.info("%s recovered after %d failures." %\
+                    (feed.URL, feed.health["failures"]))
+            feed.set_health(new_health())
+
+    # The schedule is a heap of (due time, URL). A feed's entry is only valid
+    # if it matches self.scheduled[URL], so rescheduling a feed just pushes a
+    # new entry.
+
+    def schedule_feed(self, feed, earliest = 0):
+        due = max(self.next_due(feed), earliest)
+        self.scheduled[feed.URL] = due
+        heapq.heappush(self.schedule, (due, feed.URL))
+
+    # Rebuild the schedule from scratch, when feeds or their rates may have
+    # changed.
+
+    def reschedule(self):
+        self.schedule = []
+        self.scheduled = {}
+        for feed in allfeeds.get_feeds():
+            self.schedule_feed(feed)
+
+    # Return the number of seconds until the next feed is due, or None if
+    # there aren't any.
+
+    def next_wakeup(self):
+        while self.schedule:
+            due, URL = self.schedule[0]
+            if URL in self.scheduled and self.scheduled[URL] == due:
+                return max(0, due - time.time())
+            heapq.heappop(self.schedule)
+        return None
+
+    # Whether a feed is queued, being fetched or merged, or waiting to be
+    # indexed. Only one fetch of a feed is in flight at a time, so its updates
+    # are indexed in order.
 
     def still_working(self, URL):
-        for thread, workingURL in self.threads:
-            if URL == workingURL:
+        if URL in self.working or URL in self.waiting or URL in self.merging:
+            return True
+        for doneURL, touched, error in self.done:
+            if doneURL == URL:
+                return True
+        for feed in self.queue:
+            if feed.URL == URL:
                 return True
         return False
 
+    # Queue feeds that are due, or all of them if forced. Feeds are
+    # rescheduled once they've been processed.
+
     def fetch(self, force):
-        for feed in allfeeds.get_feeds():
-            if not force and not self.needs_update(feed):
-                continue
+        if force:
+            feeds = allfeeds.get_feeds()
+        else:
+            feeds = []
+            now = time.time()
+            while self.schedule and self.schedule[0][0] <= now:
+                due, URL = heapq.heappop(self.schedule)
+                if URL not in self.scheduled or self.scheduled[URL] != due:
+                    continue
+                del self.scheduled[URL]
 
-            if self.still_working(feed.URL):
-                continue
+                feed = allfeeds.get_feed(URL)
+                if not feed:
+                    continue
 
-            thread = CantoFetchThread(feed)
-            thread.start()
-            log.debug("Started thread for feed %s" % feed.URL)
-            self.threads.append((thread, feed.URL))
+                # This is a feed's trial fetch after its breaker opened.
 
-    def process(self):
-        newthreads = []
+                if feed.health["state"] == "open":
+                    health = dict(feed.health)
+                    health["state"] = "half-open"
+                    feed.set_health(health)
 
-        for thread, URL in self.threads:
-            if thread.isAlive():
-                newthreads.append((thread, URL))
-                continue
-            thread.join()
+                feeds.append(feed)
+
+        # This runs on every pass of the main loop, so don't bother the fetch
+        # threads unless something has come due.
+
+        if not feeds:
+            return
+
+        with self.cond:
+            queued = False
+            for feed in feeds:
+                if self.still_working(feed.URL):
+                    continue
+
+                log.debug("Queued feed %s" % feed.URL)
+                self.queue.append(feed)
+                queued = True
+
+            if queued:
+                self.cond.notify_all()
+
+    # Index fetched feeds until we've spent budget seconds doing so, so that
+    # a lot of feeds finishing at once doesn't hold up requests. Returns
+    # whether there are any feeds left to index.
+
+    def process(self, budget):
+        start = time.time()
+
+        with self.cond:
+            done = self.done
+            self.done = []
+
+        for i, (URL, touched, error) in enumerate(done):
+            if time.time() - start >= budget:
+                with self.cond:
+                    self.done = done[i:] + self.done
+                return True
 
             # Feed could've disappeared between
             # fetch() and process()
 
             feed = allfeeds.get_feed(URL)
-            if feed:
-                feed.index()
+            if not feed:
+                continue
+
+            # Nothing new to index. The feed is retried once it's backed off.
+
+            if error:
+                self.failed(feed, error)
+
+            # Not modified, so there's nothing to index.
+
+            elif touched:
+                self.succeeded(feed)
+                feed.touch(touched)
+            else:
+                self.succeeded(feed)
+                if not self.commit(feed):
+                    continue
+
+            self.schedule_feed(feed, time.time() + FETCH_RETRY)
+        return False
+
+    # Swap in a feed's merged update, returning whether it's been indexed. If
+    # the feed changed while it was being merged (items were read, or
+    # expired) the merge is stale and is sent back to the fetch threads to be
+    # done over. Feeds the fetch threads couldn't merge, or whose merges keep
+    # going stale, are indexed here.
+
+    def commit(self, feed):
+        merged = feed.merged
+        feed.merged = None
+
+        if merged and merged.generation == feed.generation:
+            feed.commit(merged)
+            return True
+
+        if merged:
+            feed.update_contents = merged.contents
+
+            if merged.tries < MERGE_RETRIES:
+                log.debug("%s changed while merging, redoing." % feed.URL)
+                with self.cond:
+                    self.merging.add(feed.URL)
+                    self.merges.append(CantoMerge(feed, merged.tries + 1))
+                    self.cond.notify_all()
+                return False
+
+        feed.index()
+        return True
+
+    def stats(self):
+        failing = 0
+        broken = 0
+        for feed in allfeeds.get_feeds():
+            if feed.health["failures"]:
+                failing += 1
+            if feed.health["state"] != "closed":
+                broken += 1
+
+        with self.cond:
+            self._account()
+            if self.capacity:
+                utilisation = min(1.0, self.busy / self.capacity)
+            else:
+                utilisation = 0.0
 
-        self.threads = newthreads
+            return { "threads" : len(self.workers),
+                     "host_threads" : self.host_threads,
+                     "scheduled" : len(self.scheduled),
+                     "queued" : len(self.queue),
+                     "requests" : len(self.requests),
+                     "waiting" : len(self.waiting),
+                     "merging" : len(self.merging),
+                     "active" : len(self.working),
+                     "unprocessed" : len(self.done),
+                     "fetched" : self.fetched,
+                     "parsed" : self.parsed,
+                     "parse_workers" : self.parse_workers,
+                     "parse_mode" : self.parse_mode,
+                     "engine" : self.engine.stats() if self.engine else None,
+                     "not_modified" : self.not_modified,
+                     "identical" : self.identical,
+                     "utilisation" : utilisation,
+                     "politeness" : politeness.stats(),
+                     "failing" : failing,
+                     "broken" : broken }
@@ -9,116 +9,956 @@
 
 from .hooks import on_hook
 
+from collections import OrderedDict
+from threading import RLock
 import traceback
+import importlib
 import logging
-import shelve
+import sqlite3
+import marshal
+import pickle
+import time
+import zlib
 import dbm
-import sys
 import os
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 log = logging.getLogger("SHELF")
 
+# Writes are grouped together and committed on a work_done hook once they've
+# been pending for SYNC_INTERVAL seconds, or as soon as they add up to
+# SYNC_BYTES of encoded data.
+
+SYNC_INTERVAL = 30
+SYNC_BYTES = 4 * 1024 * 1024
+
+# Decoded documents are kept in an LRU cache, capped at CACHE_BYTES. The size
+# of a document is taken to be the size of its encoded record, so the actual
+# memory used will be some multiple of this.
+
+CACHE_BYTES = 16 * 1024 * 1024
+
+# Amount of data compaction will process on each work_done.
+
+COMPACT_STEP_BYTES = 1024 * 1024
+
+# Extensions used by the various dbm modules.
+
+DB_SUFFIXES = [ ".db", ".dat", ".dir", ".pag", ".bak" ]
+
+# Most parameters to put in a single SQLite query.
+
+SQL_BATCH = 500
+
+class CantoCache():
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        # { key : (value, nbytes) } in least to most recently used order.
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name):
+        if name in self.entries:
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return self.entries[name][0]
+        self.misses += 1
+        return None
+
+    def put(self, name, value, nbytes):
+        self.invalidate(name)
+
+        # Don't flush the whole cache for something that won't fit anyway.
+        if nbytes > self.max_bytes:
+            return
+
+        self.entries[name] = (value, nbytes)
+        self.bytes += nbytes
+
+        while self.bytes > self.max_bytes:
+            old, (value, nbytes) = self.entries.popitem(last = False)
+            self.bytes -= nbytes
+            self.evictions += 1
+
+    def invalidate(self, name):
+        if name in self.entries:
+            self.bytes -= self.entries[name][1]
+            del self.entries[name]
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def stats(self):
+        return { "hits" : self.hits,
+                 "misses" : self.misses,
+                 "evictions" : self.evictions,
+                 "entries" : len(self.entries),
+                 "bytes" : self.bytes,
+                 "max_bytes" : self.max_bytes }
+
+# Records are stored with a small header:
+#
+#   FORMAT_MAGIC | format version | codec | compression
+#
+# followed by the encoded value. Records without the header are plain pickles,
+# as written by shelve and older versions of canto.
+
+FORMAT_MAGIC = b"\x00CNT"
+FORMAT_VERSION = 1
+FORMAT_HEADER_LEN = len(FORMAT_MAGIC) + 3
+
+# Reserved key recording the format the whole database has been converted to.
+
+FORMAT_KEY = "canto-storage-format"
+
+# Codecs turn values into bytes. The pickle codec can store anything, but is
+# slow to load feedparser output. The marshal codec only handles plain types,
+# so values are converted first (FeedParserDicts become dicts, struct_times
+# become tuples) and any value that can't be converted is pickled instead.
+
+class CantoCodec():
+    def __init__(self, name, ident):
+        self.name = name
+        self.ident = ident
+
+    def encode(self, value):
+        return b""
+
+    def decode(self, data):
+        return None
+
+class PickleCodec(CantoCodec):
+    def __init__(self):
+        CantoCodec.__init__(self, "pickle", 0)
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+class MarshalCodec(CantoCodec):
+    def __init__(self):
+        CantoCodec.__init__(self, "marshal", 1)
+
+    def plain(self, value):
+        if value == None or type(value) in [ str, int, float, bool, bytes ]:
+            return value
+        if isinstance(value, dict):
+            r = {}
+            for key in value:
+                r[self.plain(key)] = self.plain(value[key])
+            return r
+        if isinstance(value, list):
+            return [ self.plain(v) for v in value ]
+        if isinstance(value, tuple):
+            return tuple([ self.plain(v) for v in value ])
+        raise TypeError("Can't marshal %s" % type(value))
+
+    def encode(self, value):
+        return marshal.dumps(self.plain(value))
+
+    def decode(self, data):
+        return marshal.loads(data)
+
+allcodecs = {}
+for codec in [ PickleCodec(), MarshalCodec() ]:
+    allcodecs[codec.name] = codec
+    allcodecs[codec.ident] = codec
+
+# Compressors are (ident, compress, decompress). Records smaller than
+# COMPRESS_MIN are never compressed.
+
+COMPRESS_MIN = 256
+
+compressors = {
+        "none" : (0, None, None),
+        "zlib" : (1, zlib.compress, zlib.decompress),
+}
+
+if zstandard:
+    compressors["zstd"] = (2, zstandard.ZstdCompressor().compress,
+            zstandard.ZstdDecompressor().decompress)
+
+for name in list(compressors.keys()):
+    compressors[compressors[name][0]] = compressors[name]
+
+# CantoShelf is a dict-like store of feed documents. Records are laid out
+# like a shelve file (UTF-8 keys, encoded values), but instead of using
+# shelve's writeback cache, which re-writes everything that's been *read*
+# since the last sync, we only keep track of the keys that have been written
+# and keep them encoded until the next commit.
+
+# Documents handed out by __getitem__ come from the cache and are shared, so
+# any changes made to them must be written back with __setitem__ (which
+# CantoFeed always does).
+
 class CantoShelf():
-    def __init__(self, filename, writeback):
+    def __init__(self, filename, writeback, sync_interval = SYNC_INTERVAL,
+            sync_bytes = SYNC_BYTES, cache_bytes = CACHE_BYTES,
+            codec = None, compression = None):
         self.writeback = writeback
         self.filename = filename
 
+        self.cache = CantoCache(cache_bytes)
+
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+
+        # Time the oldest pending write was made, and how many bytes are
+        # waiting to be committed.
+
+        self.dirty_since = None
+        self.dirty_bytes = 0
+
+        self.lock = RLock()
+
+        # In progress compaction state, and results of the last run.
+
+        self.compacting = None
+        self.compact_stats = { "runs" : 0,
+                               "last_reclaimed" : 0,
+                               "last_duration" : 0.0,
+                               "last_work" : 0.0 }
+
         self._open()
 
+        codec, compression = self._default_format(codec, compression)
+        self.codec = allcodecs[codec]
+        self.compression = compression
+
+        self.migrate_format()
+
         # Sync after a block of requests has been fulfilled,
         # close the database all together on exit.
 
         on_hook("work_done", self.sync)
+        on_hook("work_done", self.compact_step)
         on_hook("exit", self.close)
 
     def _open(self):
-        if self.writeback:
-            self.shelf = shelve.open(self.filename, 'c', None, True)
+        # { key : encoded value, or None if deleted }
+        self.dirty = {}
+        self.shelf = dbm.open(self.filename, 'c')
+
+    def _header(self, codec, compression):
+        return FORMAT_MAGIC + bytes([ FORMAT_VERSION, codec.ident,\
+                compressors[compression][0] ])
+
+    def _encode(self, value):
+        codec = self.codec
+        try:
+            data = codec.encode(value)
+        except (TypeError, ValueError):
+            codec = allcodecs["pickle"]
+            data = codec.encode(value)
+
+        compression = "none"
+        if self.compression != "none" and len(data) >= COMPRESS_MIN:
+            compression = self.compression
+            data = compressors[compression][1](data)
+
+        return self._header(codec, compression) + data
+
+    def _decode(self, data):
+        if data[:len(FORMAT_MAGIC)] != FORMAT_MAGIC:
+            return pickle.loads(data)
+
+        codec = allcodecs[data[len(FORMAT_MAGIC) + 1]]
+        decompress = compressors[data[len(FORMAT_MAGIC) + 2]][2]
+
+        data = data[FORMAT_HEADER_LEN:]
+        if decompress:
+            data = decompress(data)
+        return codec.decode(data)
+
+    # Fill in the codec and compression, if they weren't given, with whatever
+    # the database already uses, so that just starting up never rewrites it.
+    # Converting to marshal turns FeedParserDicts into dicts and struct_times
+    # into tuples, so that only happens when asked for. New databases use
+    # marshal, and databases from before formats were recorded are plain
+    # pickles.
+
+    def _default_format(self, codec, compression):
+        fmt = self._get_format()
+        if fmt:
+            old_codec = allcodecs[fmt[len(FORMAT_MAGIC) + 1]].name
+            old_compression = "none"
+            for name in compressors:
+                if isinstance(name, str) and\
+                        compressors[name][0] == fmt[len(FORMAT_MAGIC) + 2]:
+                    old_compression = name
+        elif next(self._records(), None) != None:
+            old_codec, old_compression = "pickle", "none"
         else:
-            self.shelf = shelve.open(self.filename)
+            old_codec, old_compression = "marshal", "none"
+
+        return (codec or old_codec, compression or old_compression)
+
+    # Convert every record written in some other format (or by an older
+    # version) to the current one. This is done a record at a time, so it
+    # doesn't need to hold the database in memory.
+
+    def migrate_format(self):
+        fmt = self._header(self.codec, self.compression)
+        if self._get_format() == fmt:
+            return
+
+        log.info("Converting %s to %s / %s" %\
+                (self.filename, self.codec.name, self.compression))
+
+        # Plain pickles can already be read as pickle / none records.
+
+        legacy = fmt == self._header(allcodecs["pickle"], "none")
+
+        converted = 0
+        for key, data in self._records():
+            if data[:FORMAT_HEADER_LEN] == fmt:
+                continue
+            if legacy and data[:len(FORMAT_MAGIC)] != FORMAT_MAGIC:
+                continue
+            self._put_record(key, self._encode(self._decode(data)))
+            converted += 1
+
+        self._set_format(fmt)
+        self._dirtied(0)
+        self.flush()
+
+        log.info("Converted %d records." % converted)
+
+    # Low level record access for migrate_format.
+
+    def _get_format(self):
+        if FORMAT_KEY in self.shelf:
+            return self.shelf[FORMAT_KEY]
+        return None
+
+    def _set_format(self, fmt):
+        self.shelf[FORMAT_KEY] = fmt
+
+    def _records(self):
+        for key in self.shelf.keys():
+            if key != FORMAT_KEY.encode("UTF-8"):
+                yield (key, self.shelf[key])
+
+    def _put_record(self, key, data):
+        self.shelf[key] = data
+
+    # Note that some writes have been made, and commit them if that puts us
+    # over budget (or if we have writeback disabled).
+
+    def _dirtied(self, nbytes):
+        if self.dirty_since == None:
+            self.dirty_since = time.time()
+        self.dirty_bytes += nbytes
+
+        if not self.writeback or self.dirty_bytes >= self.sync_bytes:
+            self.flush()
 
     def __setitem__(self, name, value):
-        self.shelf[name] = value
+        data = self._encode(value)
+        with self.lock:
+            self.cache.invalidate(name)
+            self.dirty[name] = data
+            self._dirtied(len(data))
+
+    # Return (decoded value, encoded size) from the underlying database.
+
+    def _read(self, name):
+        if name in self.dirty:
+            data = self.dirty[name]
+            if data == None:
+                raise KeyError(name)
+        else:
+            data = self.shelf[name]
+        return (self._decode(data), len(data))
 
     def __getitem__(self, name):
-        r = self.shelf[name]
-        return r
+        with self.lock:
+            r = self.cache.get(name)
+            if r == None:
+                r, nbytes = self._read(name)
+                self.cache.put(name, r, nbytes)
+            return r
 
     def __contains__(self, name):
-        return name in self.shelf
+        with self.lock:
+            if name in self.dirty:
+                return self.dirty[name] != None
+            return name in self.shelf
 
     def __delitem__(self, name):
-        del self.shelf[name]
+        with self.lock:
+            if name not in self:
+                raise KeyError(name)
+            self.cache.invalidate(name)
+            self.dirty[name] = None
+            self._dirtied(0)
+
+    def keys(self):
+        with self.lock:
+            r = [ k.decode("UTF-8") for k in self.shelf.keys() ]
+            r = [ k for k in r if k not in self.dirty and k != FORMAT_KEY ]
+            return r + [ k for k in self.dirty if self.dirty[k] != None ]
+
+    # Item level access. The shelve engine has to go through the whole feed
+    # document, but these give other engines a chance to only touch the
+    # records that are actually relevant.
+
+    # Return { id : entry } for the given raw (feed-level) item IDs.
+
+    def get_items(self, URL, ids):
+        r = {}
+        if URL not in self:
+            return r
+
+        ids = set(ids)
+        for entry in self[URL]["entries"]:
+            if "id" in entry and entry["id"] in ids:
+                r[entry["id"]] = entry
+        return r
+
+    # Given { id : { attribute : value } }, update the stored entries.
+
+    # Cached documents may be in use by a fetch thread merging the feed (see
+    # CantoFeed.merge), so they're never changed in place. Changes are made to
+    # copies, and the copies written.
+
+    def update_items(self, URL, updates):
+        with self.lock:
+            d = dict(self[URL])
+            entries = []
+            for entry in d["entries"]:
+                if "id" in entry and entry["id"] in updates:
+                    entry = dict(entry)
+                    entry.update(updates[entry["id"]])
+                entries.append(entry)
+            d["entries"] = entries
+            self[URL] = d
+
+    def remove_items(self, URL, ids):
+        if URL not in self:
+            return
+
+        ids = set(ids)
+        with self.lock:
+            d = dict(self[URL])
+            d["entries"] = [ e for e in d["entries"]\
+                    if "id" not in e or e["id"] not in ids ]
+            self[URL] = d
+
+    # Write a feed document where only the entries with IDs in changed (or that
+    # aren't stored yet) differ from what's on disk. Here a feed is a single
+    # record, so that's just a normal write.
+
+    def write_feed(self, URL, doc, changed):
+        self[URL] = doc
+
+    # Write out only the records that have actually changed.
+
+    def _commit(self):
+        dbs = [ self.shelf ]
+        if self.compacting:
+            dbs.append(self.compacting["db"])
+
+        for name, data in self.dirty.items():
+            for db in dbs:
+                if data == None:
+                    if name in db:
+                        del db[name]
+                else:
+                    db[name] = data
+        self.dirty = {}
+
+        if hasattr(self.shelf, "sync"):
+            self.shelf.sync()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty_since == None:
+                return
+
+            log.debug("Committing %d bytes, pending for %fs" %
+                    (self.dirty_bytes, time.time() - self.dirty_since))
+
+            self._commit()
+            self.dirty_since = None
+            self.dirty_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            r = { "cache" : self.cache.stats(),
+                  "dirty_bytes" : self.dirty_bytes,
+                  "compaction" : self.compact_stats.copy() }
+            r["compaction"]["running"] = self.compacting != None
+            return r
+
+    # Called on work_done, this is where writes are folded together.
 
     def sync(self):
-        self.shelf.sync()
+        if self.dirty_since == None:
+            return
+        if time.time() - self.dirty_since < self.sync_interval:
+            return
+        self.flush()
+
+    # Compaction. Because we're a delete heavy workload (as we drop items that
+    # are no longer relevant), and some database types (like gdbm) won't
+    # shrink themselves, trim() periodically starts a compaction.
+
+    # Compaction never runs all at once, instead it does a bounded amount of
+    # work (COMPACT_STEP_BYTES) on each work_done so clients are never left
+    # waiting on it.
 
     def trim(self):
-        self.close()
-        tries = 3
-        while tries > 0:
+        with self.lock:
+            if self.compacting:
+                return
+
+            self.flush()
+
+            try:
+                self.compacting = self._compact_start()
+            except Exception as e:
+                log.warn("Failed to start compaction:")
+                log.warn(traceback.format_exc())
+                return
+
+            if self.compacting:
+                self.compacting["start"] = time.time()
+                self.compacting["work"] = 0.0
+                self.compacting["before"] = self._db_size()
+                log.debug("Started compaction.")
+
+    def compact_step(self):
+        with self.lock:
+            if not self.compacting:
+                return
+
+            t = time.time()
             try:
-                self._open()
+                done = self._compact_step()
+                if done:
+                    self.flush()
+                    self._compact_finish()
             except Exception as e:
-                log.warn("Failed to reopen db after trim:")
+                log.warn("Failed to compact db:")
                 log.warn(traceback.format_exc())
-            tries -= 1
+                self._compact_abort()
+                self.compacting = None
+                return
+
+            self.compacting["work"] += time.time() - t
+
+            if done:
+                c = self.compacting
+                self.compacting = None
+
+                reclaimed = c["before"] - self._db_size()
+                duration = time.time() - c["start"]
+
+                self.compact_stats["runs"] += 1
+                self.compact_stats["last_reclaimed"] = reclaimed
+                self.compact_stats["last_duration"] = duration
+                self.compact_stats["last_work"] = c["work"]
+
+                log.info("Compaction reclaimed %d bytes in %fs (%fs working)"\
+                        % (reclaimed, duration, c["work"]))
+
+    # All of the files that make up a dbm database.
+
+    def _db_files(self, base):
+        d, b = os.path.split(base)
+        r = []
+        for f in os.listdir(d or "."):
+            if f == b or (f.startswith(b) and f[len(b):] in DB_SUFFIXES):
+                r.append(os.path.join(d, f))
+        return r
+
+    def _db_size(self):
+        return sum([ os.path.getsize(f) for f in\
+                self._db_files(self.filename) ])
+
+    # Copy the live records into a new database, then swap it in. Anything
+    # committed in the meantime is written to both (see _commit), and any
+    # key still waiting to be copied will be read fresh from the old one.
 
-    def _reorganize(self):
-        # This is a workaround for shelves implemented with database types
-        # (like gdbm) that won't shrink themselves.
+    def _compact_start(self):
+        dbtype = dbm.whichdb(self.filename)
+        if not dbtype:
+            return None
 
-        # Because we're a delete heavy workload (as we drop items that are no
-        # longer relevant), we check for reorganize() and use it on close,
-        # which should shrink the DB and keep it from growing into perpetuity.
+        tmpname = self.filename + ".compact"
+        for f in self._db_files(tmpname):
+            os.unlink(f)
 
-        log.debug("Checking for DB trim")
+        db = importlib.import_module(dbtype).open(tmpname, 'n')
+        return { "db" : db, "tmpname" : tmpname, "keys" : self.shelf.keys() }
 
+    def _compact_step(self):
+        c = self.compacting
+        nbytes = 0
+        while c["keys"] and nbytes < COMPACT_STEP_BYTES:
+            key = c["keys"].pop()
+            if key in self.shelf:
+                data = self.shelf[key]
+                c["db"][key] = data
+                nbytes += len(data)
+        return not c["keys"]
+
+    def _compact_finish(self):
+        c = self.compacting
+        c["db"].close()
+        self.shelf.close()
+
+        for f in self._db_files(c["tmpname"]):
+            os.rename(f, self.filename + f[len(c["tmpname"]):])
+
+        self.shelf = dbm.open(self.filename, 'c')
+
+    def _compact_abort(self):
+        c = self.compacting
         try:
-            need_reorg = False
-            db = dbm.open(self.filename, "r")
-            if hasattr(db, 'reorganize'):
-                need_reorg = True
-            db.close()
-
-            if need_reorg:
-                # Workaround Python bug 13947 (gdbm reorganize leaving hanging
-                # file descriptors) by opening the extra fds in a temporary
-                # process.
-
-                pid = os.fork()
-                if not pid:
-
-                    # Wrap everything to make sure we don't get back into the
-                    # primary server code.
-
-                    try:
-                        db = dbm.open(self.filename, "w")
-                        getattr(db, 'reorganize')()
-                        log.debug("Reorged - dying\n")
-                        db.close()
-                    except:
-                        pass
-                    sys.exit(0)
-
-                log.debug("Reorg forked as %d" % pid)
-                tries = 3
-                while True:
-                    try:
-                        tries -= 1
-                        os.waitpid(pid, 0)
-                        break
-                    except Exception as e:
-                        log.debug("Waiting, got: %s" % e)
-                        if tries <= 0:
-                            log.debug("Abandoning %d" % pid)
-                            break
-
-        except Exception as e:
-            log.warn("Failed to reorganize db:")
-            log.warn(traceback.format_exc())
+            c["db"].close()
+        except:
+            pass
+        for f in self._db_files(c["tmpname"]):
+            os.unlink(f)
 
     def close(self):
-        self.shelf.close()
-        self._reorganize()
-        self.shelf = None
+        with self.lock:
+            if self.compacting:
+                self._compact_abort()
+                self.compacting = None
+
+            self.flush()
+            self.cache.clear()
+            self.shelf.close()
+            self.shelf = None
+
+# CantoSQLiteShelf stores the same documents as CantoShelf, but splits each
+# feed into a row of feed level metadata and a row per entry, keyed by (URL,
+# item ID), so that changing an attribute on a single item only rewrites that
+# item instead of the whole feed.
+
+# Writes go straight into an open SQLite transaction, so grouping commits is
+# just a matter of when we call commit().
+
+class CantoSQLiteShelf(CantoShelf):
+    def _open(self):
+        self.shelf = sqlite3.connect(self.filename, check_same_thread = False)
+
+        # This only takes effect on a fresh database, and lets us reclaim free
+        # pages a few at a time instead of with a blocking VACUUM.
+
+        self.shelf.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+        self.shelf.execute("CREATE TABLE IF NOT EXISTS feeds "\
+                "(url TEXT PRIMARY KEY, split INTEGER, data BLOB)")
+        self.shelf.execute("CREATE TABLE IF NOT EXISTS items "\
+                "(url TEXT, pos INTEGER, id TEXT, data BLOB, "\
+                "PRIMARY KEY (url, pos))")
+        self.shelf.execute("CREATE INDEX IF NOT EXISTS items_by_id "\
+                "ON items (url, id)")
+        self.shelf.execute("CREATE TABLE IF NOT EXISTS meta "\
+                "(key TEXT PRIMARY KEY, value BLOB)")
+        self.shelf.commit()
+
+    def _get_format(self):
+        r = self.shelf.execute("SELECT value FROM meta WHERE key = ?",
+                (FORMAT_KEY,)).fetchone()
+        if r:
+            return r[0]
+        return None
+
+    def _set_format(self, fmt):
+        self.shelf.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                (FORMAT_KEY, fmt))
+
+    # Records are identified by (table, rowid), and only the rowids are
+    # gathered up front.
+
+    def _records(self):
+        for table in [ "feeds", "items" ]:
+            rowids = [ r[0] for r in\
+                    self.shelf.execute("SELECT rowid FROM %s" % table) ]
+            for rowid in rowids:
+                data = self.shelf.execute("SELECT data FROM %s WHERE "\
+                        "rowid = ?" % table, (rowid,)).fetchone()[0]
+                yield ((table, rowid), data)
+
+    def _put_record(self, key, data):
+        table, rowid = key
+        self.shelf.execute("UPDATE %s SET data = ? WHERE rowid = ?" % table,
+                (data, rowid))
+
+    def _write_items(self, name, entries):
+        self.shelf.execute("DELETE FROM items WHERE url = ?", (name,))
+        rows = []
+        nbytes = 0
+        for pos, entry in enumerate(entries):
+            if "id" in entry:
+                i = str(entry["id"])
+            else:
+                i = None
+            data = self._encode(entry)
+            nbytes += len(data)
+            rows.append((name, pos, i, data))
+        self.shelf.executemany("INSERT INTO items VALUES (?, ?, ?, ?)", rows)
+        return nbytes
+
+    # Feed documents (dicts with "entries") are split, anything else is stored
+    # whole in the feeds table.
+
+    def __setitem__(self, name, value):
+        with self.lock:
+            self.cache.invalidate(name)
+            if isinstance(value, dict) and "entries" in value:
+                doc = dict(value)
+                entries = doc["entries"]
+                del doc["entries"]
+                nbytes = self._write_items(name, entries)
+                split = 1
+            else:
+                doc = value
+                self.shelf.execute("DELETE FROM items WHERE url = ?", (name,))
+                nbytes = 0
+                split = 0
+
+            data = self._encode(doc)
+            self.shelf.execute("INSERT OR REPLACE INTO feeds VALUES (?, ?, ?)",
+                    (name, split, data))
+
+            self._dirtied(nbytes + len(data))
+
+    def _read(self, name):
+        r = self.shelf.execute("SELECT split, data FROM feeds WHERE url = ?",
+                (name,)).fetchone()
+        if not r:
+            raise KeyError(name)
+
+        split, data = r
+        doc = self._decode(data)
+        nbytes = len(data)
+
+        if split:
+            doc["entries"] = []
+            for row in self.shelf.execute("SELECT data FROM items WHERE "\
+                    "url = ? ORDER BY pos", (name,)):
+                doc["entries"].append(self._decode(row[0]))
+                nbytes += len(row[0])
+
+        return (doc, nbytes)
+
+    def __contains__(self, name):
+        with self.lock:
+            r = self.shelf.execute("SELECT 1 FROM feeds WHERE url = ?",
+                    (name,)).fetchone()
+            return r != None
+
+    def __delitem__(self, name):
+        with self.lock:
+            if name not in self:
+                raise KeyError(name)
+            self.cache.invalidate(name)
+            self.shelf.execute("DELETE FROM items WHERE url = ?", (name,))
+            self.shelf.execute("DELETE FROM feeds WHERE url = ?", (name,))
+            self._dirtied(0)
+
+    def keys(self):
+        with self.lock:
+            return [ r[0] for r in\
+                    self.shelf.execute("SELECT url FROM feeds") ]
+
+    def get_items(self, URL, ids):
+        r = {}
+        with self.lock:
+            for i in ids:
+                row = self.shelf.execute("SELECT data FROM items WHERE "\
+                        "url = ? AND id = ?", (URL, str(i))).fetchone()
+                if row:
+                    r[i] = self._decode(row[0])
+        return r
+
+    def update_items(self, URL, updates):
+        with self.lock:
+            self.cache.invalidate(URL)
+
+            # Read the rows in batches (staying under SQLite's limit on query
+            # parameters), and write them back in one go.
+
+            ids = dict([ (str(i), i) for i in updates ])
+            keys = list(ids.keys())
+            rows = []
+
+            for start in range(0, len(keys), SQL_BATCH):
+                batch = keys[start:start + SQL_BATCH]
+                query = "SELECT pos, id, data FROM items WHERE url = ? AND "\
+                        "id IN (%s)" % ", ".join([ "?" ] * len(batch))
+                rows += self.shelf.execute(query, [ URL ] + batch).fetchall()
+
+            nbytes = 0
+            writes = []
+            for pos, i, data in rows:
+                entry = self._decode(data)
+                entry.update(updates[ids[i]])
+
+                data = self._encode(entry)
+                nbytes += len(data)
+                writes.append((data, URL, pos))
+
+            self.shelf.executemany("UPDATE items SET data = ? WHERE "\
+                    "url = ? AND pos = ?", writes)
+
+            self._dirtied(nbytes)
+
+    # Positions don't have to be contiguous, so removing items is just
+    # deleting their rows.
+
+    def remove_items(self, URL, ids):
+        with self.lock:
+            self.cache.invalidate(URL)
+            self.shelf.executemany("DELETE FROM items WHERE url = ? AND "\
+                    "id = ?", [ (URL, str(i)) for i in ids ])
+            self._dirtied(0)
+
+    # Only touch the item rows that have changed. Rows for entries that are
+    # gone are deleted, new and changed entries are (re)encoded, and the rest
+    # just have their position updated if the order shifted.
+
+    def write_feed(self, URL, doc, changed):
+        with self.lock:
+            entries = doc["entries"]
+
+            row = self.shelf.execute("SELECT split FROM feeds WHERE url = ?",
+                    (URL,)).fetchone()
+            if not row or not row[0]:
+                self[URL] = doc
+                return
+
+            ids = [ str(e["id"]) for e in entries if "id" in e ]
+            if len(ids) != len(entries) or len(set(ids)) != len(ids):
+                self[URL] = doc
+                return
+
+            self.cache.invalidate(URL)
+
+            stored = {}
+            for i, pos in self.shelf.execute("SELECT id, pos FROM items "\
+                    "WHERE url = ?", (URL,)):
+                stored[i] = pos
+
+            removed = [ (URL, stored[i]) for i in stored if i not in ids ]
+            self.shelf.executemany("DELETE FROM items WHERE url = ? AND "\
+                    "pos = ?", removed)
+
+            # Move shifted rows out of the way first, so we never collide on
+            # (url, pos) while shuffling.
+
+            moved = []
+            for pos, i in enumerate(ids):
+                if i in stored and stored[i] != pos:
+                    moved.append((pos, URL, stored[i]))
+
+            self.shelf.executemany("UPDATE items SET pos = -1 - ? WHERE "\
+                    "url = ? AND pos = ?", moved)
+            self.shelf.execute("UPDATE items SET pos = -1 - pos WHERE "\
+                    "url = ? AND pos < 0", (URL,))
+
+            nbytes = 0
+            rows = []
+            for pos, entry in enumerate(entries):
+                i = ids[pos]
+                if i in stored and entry["id"] not in changed:
+                    continue
+                data = self._encode(entry)
+                nbytes += len(data)
+                rows.append((URL, pos, i, data))
+
+            self.shelf.executemany("INSERT OR REPLACE INTO items "\
+                    "VALUES (?, ?, ?, ?)", rows)
+
+            meta = dict(doc)
+            del meta["entries"]
+            data = self._encode(meta)
+            self.shelf.execute("UPDATE feeds SET data = ? WHERE url = ?",
+                    (data, URL))
+
+            self._dirtied(nbytes + len(data))
+
+    # Pull every document out of an old shelve feeds file. This is only done
+    # once, the first time the SQLite database is used (tracked with SQLite's
+    # user_version), and the shelve file is left alone in case the user wants
+    # to go back.
+
+    def migrate(self, filename):
+        with self.lock:
+            if self.shelf.execute("PRAGMA user_version").fetchone()[0]:
+                return
+
+            if dbm.whichdb(filename):
+                log.info("Migrating %s into %s" % (filename, self.filename))
+
+                old = dbm.open(filename, 'r')
+                try:
+                    for key in old.keys():
+                        if key != FORMAT_KEY.encode("UTF-8"):
+                            self[key.decode("UTF-8")] = self._decode(old[key])
+                finally:
+                    old.close()
+
+                log.info("Migration complete.")
+
+            self.shelf.execute("PRAGMA user_version = 1")
+            self._dirtied(0)
+            self.flush()
+
+    def _commit(self):
+        self.shelf.commit()
+
+    def _db_size(self):
+        return os.path.getsize(self.filename)
+
+    # For SQLite, compaction is returning free pages to the filesystem
+    # COMPACT_STEP_BYTES at a time with incremental_vacuum.
+
+    def _compact_start(self):
+        if self.shelf.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            log.debug("Database not using incremental vacuum, can't compact.")
+            return None
+
+        if not self.shelf.execute("PRAGMA freelist_count").fetchone()[0]:
+            return None
+
+        page_size = self.shelf.execute("PRAGMA page_size").fetchone()[0]
+        return { "pages" : max(1, COMPACT_STEP_BYTES // page_size) }
+
+    def _compact_step(self):
+        self.shelf.execute("PRAGMA incremental_vacuum(%d)" %\
+                self.compacting["pages"]).fetchall()
+        self._dirtied(0)
+        return not self.shelf.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def _compact_finish(self):
+        pass
+
+    def _compact_abort(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.compacting = None
+            self.flush()
+            self.cache.clear()
+            self.shelf.close()
+            self.shelf = None
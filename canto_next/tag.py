@@ -17,6 +17,18 @@ class CantoTags():
         self.tags = {}
         self.changed_tags = []
 
+        # { item : [ tags it's in ] }, so we don't have to scan every tag to
+        # find an item.
+        self.item_tags = {}
+
+        # What's happened to each changed tag since the last tag_change, for
+        # clients that want deltas instead of re-requesting the whole tag.
+        # { tag : { "added" : { item : True }, "removed" : set(items),
+        # "changed" : { item : set(attributes) } } } or None for tags whose
+        # changes aren't tracked (on reset).
+
+        self.deltas = {}
+
         # Per-tag transforms
         self.tag_transforms = {}
 
@@ -35,8 +47,10 @@ class CantoTags():
     def items_to_tags(self, ids):
         tags = []
         for id in ids:
-            for tag in self.tags:
-                if id in self.tags[tag] and tag not in tags:
+            if id not in self.item_tags:
+                continue
+            for tag in self.item_tags[id]:
+                if tag not in tags:
                     tags.append(tag)
         return tags
 
@@ -44,6 +58,28 @@ class CantoTags():
         if tag not in self.changed_tags:
             self.changed_tags.append(tag)
 
+    def _delta(self, tag):
+        if tag not in self.deltas:
+            self.deltas[tag] = { "added" : {}, "removed" : set(),
+                    "changed" : {} }
+        return self.deltas[tag]
+
+    # Note changes to item attributes. An empty list of attributes means the
+    # content changed in an unknown way.
+
+    def items_changed(self, ids, attributes):
+        for id in ids:
+            if id not in self.item_tags:
+                continue
+            for tag in self.item_tags[id]:
+                delta = self._delta(tag)
+                if delta == None:
+                    continue
+                if id not in delta["changed"]:
+                    delta["changed"][id] = set()
+                delta["changed"][id].update(attributes)
+                self.tag_changed(tag)
+
     def add_tag(self, id, name, category=""):
 
         # Tags are actually stored as category:name, this is so that you can
@@ -70,15 +106,54 @@ class CantoTags():
                     call_hook("new_tag", [[ name ]])
 
             # Add to tag.
-            if id not in self.tags[name]:
+            if id not in self.item_tags:
+                self.item_tags[id] = []
+
+            if name not in self.item_tags[id]:
+                self.item_tags[id].append(name)
                 self.tags[name].append(id)
                 self.tag_changed(name)
 
+                # Something removed and re-added in the same cycle
+                # hasn't changed as far as clients are concerned.
+
+                delta = self._delta(name)
+                if delta != None:
+                    if id in delta["removed"]:
+                        delta["removed"].remove(id)
+                    else:
+                        delta["added"][id] = True
+
     def remove_id(self, id):
-        for tag in self.tags:
-            if id in self.tags[tag]:
-                self.tags[tag].remove(id)
-                self.tag_changed(tag)
+        self.remove_ids([ id ])
+
+    # Remove a number of items, only going through each affected tag once.
+
+    def remove_ids(self, ids):
+        removed = {}
+        for id in ids:
+            if id not in self.item_tags:
+                continue
+            for tag in self.item_tags[id]:
+                if tag not in removed:
+                    removed[tag] = set()
+                removed[tag].add(id)
+            del self.item_tags[id]
+
+        for tag in removed:
+            self.tags[tag] = [ x for x in self.tags[tag]\
+                    if x not in removed[tag] ]
+            self.tag_changed(tag)
+
+            delta = self._delta(tag)
+            if delta != None:
+                for id in removed[tag]:
+                    if id in delta["added"]:
+                        del delta["added"][id]
+                    else:
+                        delta["removed"].add(id)
+                    if id in delta["changed"]:
+                        del delta["changed"][id]
 
     def get_tag(self, tag):
         if tag in list(self.tags.keys()):
@@ -99,7 +174,19 @@ class CantoTags():
     def do_tag_changes(self):
         for tag in self.changed_tags:
             call_hook("tag_change", [ tag ])
+
+            # Items are only ever appended to tags, so added items are
+            # already in tag order.
+
+            delta = None
+            if tag in self.deltas and self.deltas[tag] != None:
+                delta = self.deltas[tag]
+                delta["added"] = list(delta["added"].keys())
+
+            call_hook("tag_delta", [ tag, delta ])
+
         self.changed_tags = []
+        self.deltas = {}
 
     def tag_transform(self, tag, transform):
         self.tag_transforms[tag] = transform
@@ -110,10 +197,15 @@ class CantoTags():
     def reset(self):
         self.oldtags = self.tags
         self.tags = {}
+        self.item_tags = {}
         self.tag_transforms = {}
         self.extra_tags = {}
 
+        # Everything is about to be re-added, so there's no point keeping
+        # track of individual changes.
+
         for tag in self.oldtags:
             self.tag_changed(tag)
+            self.deltas[tag] = None
 
 alltags = CantoTags()
@@ -1,17 +1,22 @@
 # Canto Reddit Plugin
 # by Jack Miller
-# v1.1
+# v1.2
 #
 # If this is placed in the plugins directory, it will add a new sort:
 # reddit_score_sort, and will add "score [subreddit]" to the beginning of
 # every relevant feed item.
 
-# ALWAYS REFRESH, if true, each update will re-fetch Reddit JSON to give
+# ALWAYS REFRESH, if true, updates will re-fetch Reddit JSON to give
 # updated scores, comment counts etc. Makes each update take a lot longer,
 # and will use a lot more bandwidth.
 
 ALWAYS_REFRESH = True
 
+# REFRESH_AGE, with ALWAYS_REFRESH, is how old (in seconds) an item's JSON has
+# to be before it's re-fetched. 0 re-fetches it on every update.
+
+REFRESH_AGE = 300
+
 # PREPEND_SCORE, if true will add the score to the entry title. Note, this
 # doesn't effect the sort.
 
@@ -23,11 +28,10 @@ PREPEND_SUBREDDIT = True
 
 # You shouldn't have to change anything beyond this line.
 
-from canto_next.fetch import DaemonFetchThreadPlugin
-from canto_next.feed import DaemonFeedPlugin
+from canto_next.fetch import DaemonFetchThreadPlugin, politeness
+from canto_next.feed import DaemonFeedPlugin, allitems
 from canto_next.transform import transform_locals, CantoTransform 
 
-import urllib.request, urllib.error, urllib.parse
 import logging
 import time
 import json
@@ -35,6 +39,16 @@ import re
 
 log = logging.getLogger("REDDIT")
 
+# Reddit enforces a maximum of 1 request every 2 seconds. This can be
+# overridden with host_rates in the config.
+
+politeness.set_default("reddit.com", 2)
+politeness.set_default("*.reddit.com", 2)
+
+# The most fullnames by_id will take at once.
+
+BATCH_SIZE = 100
+
 class RedditFetchJSON(DaemonFetchThreadPlugin):
     def __init__(self):
         self.plugin_attrs = {
@@ -43,67 +57,119 @@ class RedditFetchJSON(DaemonFetchThreadPlugin):
 
         self.id_regex = re.compile(".*comments/([^/]*)/.*")
 
+    # Return a callback to spread a by_id response over the entries in
+    # batch, { reddit id : entry }. Each gets the listing it would have gotten
+    # fetching it alone.
+
+    def got_redditJSON(self, batch):
+        def callback(response):
+            if not response:
+                return
+
+            status, headers, body, URL = response
+            try:
+                r = json.loads(body.decode())
+                children = r["data"]["children"]
+            except Exception as e:
+                log.error("Error parsing Reddit JSON: %s" % e)
+                return
+
+            now = time.time()
+            for child in children:
+                try:
+                    reddit_id = child["data"]["id"]
+                except Exception as e:
+                    log.error("Error parsing Reddit JSON: %s" % e)
+                    continue
+
+                if reddit_id not in batch:
+                    continue
+
+                entry = batch[reddit_id]
+                entry["reddit-id"] = reddit_id
+                entry["reddit-json"] = { "kind" : r.get("kind", "Listing"),
+                        "data" : { "children" : [ child ] } }
+                entry["reddit-json-time"] = now
+
+        return callback
+
     def fetch_redditJSON(self, **kwargs):
         if "reddit.com" not in kwargs["feed"].URL:
             return
 
-        last_fetch = 0
-
-        new_ids = [ json.dumps({ "URL" : kwargs["feed"].URL, "ID" : i["id"] }) for i in kwargs["newcontent"]["entries"] ]
+        # Handles of the entries we already know about.
+        new_ids = {}
+        for i in kwargs["newcontent"]["entries"]:
+            handle = allitems.lookup(kwargs["feed"].URL, i["id"])
+            if handle != None:
+                new_ids[i["id"]] = handle
 
         attrs = {}
-        for id in new_ids:
-            attrs[id] = ["reddit-json"]
+        for id in new_ids.values():
+            attrs[id] = ["reddit-json", "reddit-json-time"]
 
-        old_attrs = kwargs["feed"].get_attributes(new_ids, attrs)
+        old_attrs = kwargs["feed"].get_attributes(list(new_ids.values()), attrs)
         log.debug("old_attrs: %s" % old_attrs)
 
+        # { reddit id : entry } of entries that need JSON.
+        missing = {}
+
+        now = time.time()
+
         for entry in kwargs["newcontent"]["entries"]:
             if "reddit-json" in entry and not ALWAYS_REFRESH:
                 continue
 
-            entry_id = json.dumps({"URL" : kwargs["feed"].URL, "ID" : entry["id"]})
+            entry_id = new_ids.get(entry["id"])
+
+            # If the JSON is not empty or errored, move it over. If it's still
+            # fresh enough, we're done, otherwise it's kept in case the
+            # refresh fails.
 
-            # If not always refresh, and the JSON is not empty or errored, move it over
-            if not ALWAYS_REFRESH and entry_id in old_attrs and\
+            if entry_id in old_attrs and\
                     "reddit-json" in old_attrs[entry_id] and\
                     old_attrs[entry_id]["reddit-json"] and\
                     "error" not in old_attrs[entry_id]["reddit-json"]:
                 entry["reddit-json"] = old_attrs[entry_id]["reddit-json"]
-                log.debug("Using old JSON: %s" % entry["reddit-json"])
-            else:
-                # Reddit now enforces a maximum of 1 request every 2 seconds.
-                # We can afford to play by the rules because this runs in a
-                # separate thread.
 
-                period = 2
+                # Entries from before we tracked this have no time (which
+                # get_attributes gives as ""), so they're due a refresh.
 
-                cur_time = time.time()
-                delta = cur_time - last_fetch
-                if delta < period:
-                    log.debug("Waiting %s seconds" % (period - delta))
-                    time.sleep(period - delta)
-                last_fetch = cur_time
+                fetched = old_attrs[entry_id].get("reddit-json-time") or 0
+                if not isinstance(fetched, (int, float)):
+                    fetched = 0
+                entry["reddit-json-time"] = fetched
 
-                # Grab the story summary. Alternatively, we could grab
-                # entry["link"] + "/.json" but that includes comments and
-                # can be fairly large for popular threads.
+                if not ALWAYS_REFRESH or now - fetched < REFRESH_AGE:
+                    log.debug("Using old JSON: %s" % entry["reddit-json"])
+                    continue
 
-                try:
-                    m = self.id_regex.match(entry["link"])
-                    reddit_id = m.groups()[0]
+            # Grab the story summary. Alternatively, we could grab
+            # entry["link"] + "/.json" but that includes comments and
+            # can be fairly large for popular threads.
 
-                    req = urllib.request.Request(\
-                            "http://reddit.com/by_id/t3_" + reddit_id + ".json",
-                            headers = { "User-Agent" : "Canto-Reddit-Plugin"})
-                    response = urllib.request.urlopen(req)
+            try:
+                m = self.id_regex.match(entry["link"])
+                missing[m.groups()[0]] = entry
+            except Exception as e:
+                log.error("Error fetching Reddit JSON: %s" % e)
 
-                    entry["reddit-id"] = reddit_id
+        # by_id takes a comma separated list of fullnames, so fetch them in
+        # batches. The requests are queued until Reddit's rate limit allows
+        # them, and the feed isn't indexed until they're done.
 
-                    r = json.loads(response.read().decode())
-                    entry["reddit-json"] = r
-                except Exception as e:
-                    log.error("Error fetching Reddit JSON: %s" % e)
+        reddit_ids = list(missing.keys())
+        for i in range(0, len(reddit_ids), BATCH_SIZE):
+            ids = reddit_ids[i:i + BATCH_SIZE]
+            batch = dict([ (reddit_id, missing[reddit_id]) for reddit_id in ids ])
+
+            fullnames = ",".join([ "t3_" + reddit_id for reddit_id in ids ])
+            log.debug("Fetching Reddit JSON for %s" % fullnames)
+
+            politeness.request(kwargs["feed"],
+                    "http://reddit.com/by_id/" + fullnames + ".json",
+                    self.got_redditJSON(batch),
+                    { "User-Agent" : "Canto-Reddit-Plugin" })
 
 class RedditScoreSort(CantoTransform):
     def __init__(self):
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2010 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+from canto_next.asyncfetch import CantoAsyncFetch, CantoHTTPError, FetchError
+from canto_next.fetch import CantoFetch
+from canto_next.storage import CantoShelf
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+import unittest
+import tempfile
+import shutil
+import gzip
+
+FEED = b"<rss><channel><title>Test</title></channel></rss>"
+MAX_SIZE = 1024
+
+# A stand-in for a feed server, speaking HTTP/1.1 so connections are kept
+# alive between requests.
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, headers = {}):
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/feed":
+            self.send_body(FEED)
+
+        elif self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(FEED), 10):
+                chunk = FEED[i:i + 10]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+
+        elif self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/feed")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        elif self.path == "/gzip":
+            self.send_body(gzip.compress(FEED),
+                    { "Content-Encoding" : "gzip" })
+
+        elif self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.send_header("ETag", '"v1"')
+                self.end_headers()
+            else:
+                self.send_body(FEED, { "ETag" : '"v1"' })
+
+        elif self.path == "/big":
+            self.send_body(b"x" * (MAX_SIZE + 1))
+
+        elif self.path == "/bigchunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(4):
+                self.wfile.write(b"%x\r\n%s\r\n" % (MAX_SIZE, b"x" * MAX_SIZE))
+            self.wfile.write(b"0\r\n\r\n")
+
+        elif self.path == "/bomb":
+            self.send_body(gzip.compress(b"x" * (MAX_SIZE * 100)),
+                    { "Content-Encoding" : "gzip" })
+
+        else:
+            self.send_error(404)
+
+class TestAsyncFetch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.server.daemon_threads = True
+        cls.thread = Thread(target = cls.server.serve_forever, daemon = True)
+        cls.thread.start()
+        cls.base = "http://127.0.0.1:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.engine = CantoAsyncFetch(timeout = 5, max_size = MAX_SIZE)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.stop()
+
+    def get(self, path, headers = {}):
+        return self.engine.download(self.base + path, headers)
+
+    def test_keep_alive(self):
+        for i in range(3):
+            status, headers, body, URL = self.get("/feed")
+            self.assertEqual(status, 200)
+            self.assertEqual(body, FEED)
+
+        stats = self.engine.stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["reused"], 2)
+
+    def test_chunked(self):
+        status, headers, body, URL = self.get("/chunked")
+        self.assertEqual(body, FEED)
+
+        # The connection is still good afterwards.
+        self.get("/feed")
+        self.assertEqual(self.engine.stats()["reused"], 1)
+
+    def test_redirect(self):
+        status, headers, body, URL = self.get("/redirect")
+        self.assertEqual(status, 200)
+        self.assertEqual(body, FEED)
+        self.assertEqual(URL, self.base + "/feed")
+
+    def test_gzip(self):
+        status, headers, body, URL = self.get("/gzip")
+        self.assertEqual(body, FEED)
+
+    def test_not_modified(self):
+        status, headers, body, URL = self.get("/etag")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["etag"], '"v1"')
+
+        status, headers, body, URL = self.get("/etag",
+                { "If-None-Match" : headers["etag"] })
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+
+    def test_size_cap(self):
+        for path in [ "/big", "/bigchunked", "/bomb" ]:
+            self.assertRaises(FetchError, self.get, path)
+
+        # Small enough is fine.
+        self.assertEqual(self.get("/feed")[2], FEED)
+
+    def test_not_found(self):
+        try:
+            self.get("/missing")
+        except CantoHTTPError as e:
+            self.assertEqual(e.status, 404)
+        else:
+            self.fail("No error for 404")
+
+# Switching the engine off stops it, once no fetch thread is using it.
+
+class TestEngineSwitch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shelf = CantoShelf(self.dir + "/feeds", True)
+        self.fetch = CantoFetch(self.shelf, 1, 1, engine = "async")
+
+    def tearDown(self):
+        self.fetch.stop()
+        self.shelf.close()
+        shutil.rmtree(self.dir)
+
+    def test_switch_off(self):
+        engine = self.fetch.engine
+        self.assertTrue(engine.thread)
+
+        self.fetch.configure(1, 1, engine = "urllib")
+        self.assertEqual(self.fetch.engine, None)
+        self.assertEqual(engine.thread, None)
+
+    def test_switch_off_in_use(self):
+        engine = self.fetch.use_engine()
+
+        self.fetch.configure(1, 1, engine = "urllib")
+        self.assertTrue(engine.thread)
+
+        self.fetch.release_engine(engine)
+        self.assertEqual(engine.thread, None)
+
+    def test_stop(self):
+        engine = self.fetch.engine
+        self.fetch.stop()
+        self.assertEqual(engine.thread, None)
+
+if __name__ == "__main__":
+    unittest.main()
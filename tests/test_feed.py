@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2010 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+from canto_next.feed import CantoFeed, expiry, allitems, summary_key,\
+        new_health
+from canto_next.storage import CantoShelf, CantoSQLiteShelf
+
+import unittest
+import tempfile
+import shutil
+import time
+
+DAY = 24 * 60 * 60
+
+def contents(ids, when):
+    return { "canto_update" : when,
+             "entries" : [ { "id" : i, "title" : "Title %s" % i }\
+                     for i in ids ] }
+
+class TestDroppedItems(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shelf = CantoShelf(self.dir + "/feeds", True)
+        self.feed = CantoFeed(self.shelf, "Test", "http://example.com/%s" %\
+                self.id(), 10, DAY, False)
+
+    def tearDown(self):
+        self.shelf.close()
+        shutil.rmtree(self.dir)
+
+    def handle(self, raw_id):
+        for item in self.feed.items:
+            if item.raw_id == raw_id:
+                return item.handle
+
+    # An item that drops out of the feed after several fetches that found
+    # nothing new was last seen at the last of those, not when the content on
+    # disk was last written.
+
+    def test_dropped_after_unchanged_fetches(self):
+        now = time.time()
+        feed = self.feed
+
+        feed.update_contents = contents([ "a", "b" ], now - 10 * DAY)
+        feed.index()
+
+        for hours in [ 72, 48, 24, 1 ]:
+            feed.touch({ "canto_update" : now - hours * 60 * 60,
+                         "canto_unchanged" : "not_modified" })
+
+        feed.update_contents = contents([ "a" ], now)
+        feed.index()
+
+        h = self.handle("b")
+        self.assertIn(h, feed.expiring)
+        self.assertAlmostEqual(feed.expiring[h], now - 60 * 60 + DAY,
+                delta = 1)
+
+        expiry.expire(1000)
+        self.assertIn(h, allitems)
+        self.assertEqual([ i.raw_id for i in feed.items ], [ "a", "b" ])
+
+        attrs = feed.get_attributes([ h ], { h : [ "canto_update" ] })
+        self.assertAlmostEqual(attrs[h]["canto_update"], now - 60 * 60,
+                delta = 1)
+
+    # Items still in the feed report the last fetch, as they always have,
+    # even if their entries weren't rewritten.
+
+    def test_in_feed_last_seen(self):
+        now = time.time()
+        feed = self.feed
+
+        feed.update_contents = contents([ "a" ], now - DAY)
+        feed.index()
+        feed.touch({ "canto_update" : now,
+                     "canto_unchanged" : "identical" })
+
+        h = self.handle("a")
+        attrs = feed.get_attributes([ h ], { h : [ "canto_update" ] })
+        self.assertEqual(attrs[h]["canto_update"], now)
+
+# edit_* plugins are given the new and changed entries, and their edits are
+# written out whatever the storage engine.
+
+class TestEditPlugins(unittest.TestCase):
+    shelf_class = CantoShelf
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shelf = self.shelf_class(self.dir + "/feeds", True)
+        self.URL = "http://example.com/%s" % self.id()
+        self.feed = CantoFeed(self.shelf, "Test", self.URL, 10, DAY, False)
+
+        self.offered = []
+        self.feed.plugin_attrs["edit_test"] = self.edit_test
+
+    def tearDown(self):
+        self.shelf.close()
+        shutil.rmtree(self.dir)
+
+    def edit_test(self, **kwargs):
+        for entry in kwargs["newcontent"]["entries"]:
+            self.offered.append(entry["id"])
+            entry["title"] = "Edited " + entry["title"]
+
+    def test_edit_changed(self):
+        now = time.time()
+        feed = self.feed
+
+        feed.update_contents = contents([ "a", "b" ], now - DAY)
+        feed.index()
+        self.assertEqual(self.offered, [ "a", "b" ])
+
+        # a is unchanged (the title the plugin sees is the fetched one), b
+        # has changed and c is new.
+
+        self.offered = []
+        new = contents([ "a", "b", "c" ], now)
+        new["entries"][1]["title"] = "New title b"
+        feed.update_contents = new
+        feed.index()
+        self.assertEqual(self.offered, [ "b", "c" ])
+
+        self.shelf.sync()
+        titles = [ e["title"] for e in self.shelf[self.URL]["entries"] ]
+        self.assertEqual(titles, [ "Edited Title a", "Edited New title b",
+            "Edited Title c" ])
+
+class TestEditPluginsSQLite(TestEditPlugins):
+    shelf_class = CantoSQLiteShelf
+
+# Attributes can be kept in a cold record of their own, and setting one
+# replaces what's in the record.
+
+class TestColdAttributes(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shelf = CantoShelf(self.dir + "/feeds", True)
+        self.feed = CantoFeed(self.shelf, "Test", "http://example.com/%s" %\
+                self.id(), 10, DAY, False,
+                cold_attributes = [ "content", "summary" ])
+
+    def tearDown(self):
+        self.shelf.close()
+        shutil.rmtree(self.dir)
+
+    def test_set_cold(self):
+        feed = self.feed
+
+        c = contents([ "a" ], time.time())
+        c["entries"][0]["content"] = "Old content"
+        c["entries"][0]["summary"] = "Summary"
+        feed.update_contents = c
+        feed.index()
+
+        self.assertNotIn("content", self.shelf[feed.URL]["entries"][0])
+
+        h = feed.items[0].handle
+        feed.set_attributes([ h ], { h : { "content" : "New content" } })
+
+        attrs = feed.get_attributes([ h ], { h : [ "summary", "content" ] })
+        self.assertEqual(attrs[h], { "summary" : "Summary",
+            "content" : "New content" })
+
+# The feed's fetch state is its own, not the shelf's cached summary, and only
+# changes on disk when it's set.
+
+class TestFetchState(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shelf = CantoShelf(self.dir + "/feeds", True)
+        self.feed = CantoFeed(self.shelf, "Test", "http://example.com/%s" %\
+                self.id(), 10, DAY, False)
+
+    def tearDown(self):
+        self.shelf.close()
+        shutil.rmtree(self.dir)
+
+    def test_health(self):
+        feed = self.feed
+        key = summary_key(feed.URL)
+
+        feed.update_contents = contents([ "a" ], time.time())
+        feed.index()
+
+        health = new_health()
+        health["state"] = "open"
+        feed.set_health(health)
+
+        feed.load_fetch_state()
+        feed.health["state"] = "changed"
+        self.assertEqual(self.shelf[key]["health"]["state"], "open")
+
+        health = dict(feed.health)
+        health["state"] = "half-open"
+        feed.set_health(health)
+        self.assertEqual(self.shelf[key]["health"]["state"], "half-open")
+
+if __name__ == "__main__":
+    unittest.main()
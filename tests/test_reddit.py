@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#Canto - RSS reader backend
+#   Copyright (C) 2010 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+from canto_next.feed import CantoFeed
+from canto_next.storage import CantoShelf
+
+import plugins.reddit as reddit
+
+from unittest import mock
+import unittest
+import tempfile
+import shutil
+import time
+
+URL = "http://www.reddit.com/.rss"
+
+def entry(i):
+    return { "id" : "e%d" % i, "title" : "Story %d" % i,
+             "link" : "http://www.reddit.com/r/x/comments/id%d/story/" % i }
+
+def listing(i):
+    return { "kind" : "Listing", "data" : { "children" :\
+            [ { "kind" : "t3", "data" : { "id" : "id%d" % i } } ] } }
+
+class TestRedditJSON(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shelf = CantoShelf(self.dir + "/feeds", True)
+        self.feed = CantoFeed(self.shelf, "Reddit", URL, 10, 0, False)
+        self.plugin = reddit.RedditFetchJSON()
+
+    def tearDown(self):
+        self.shelf.close()
+        shutil.rmtree(self.dir)
+
+    def refresh(self):
+        content = { "canto_update" : time.time(),
+                    "entries" : [ entry(i) for i in range(3) ] }
+
+        requests = []
+        with mock.patch.object(reddit.politeness, "request",
+                lambda feed, URL, cb, headers = None:\
+                        requests.append(URL)):
+            self.plugin.fetch_redditJSON(feed = self.feed,
+                    newcontent = content)
+        return content, requests
+
+    # Entries stored before reddit-json-time was kept have JSON but no time,
+    # and are refreshed rather than breaking the feed.
+
+    def test_upgrade(self):
+        old = { "canto_update" : time.time(), "entries" : [] }
+        for i in range(3):
+            e = entry(i)
+            e["reddit-json"] = listing(i)
+            old["entries"].append(e)
+
+        self.feed.update_contents = old
+        self.feed.index()
+
+        content, requests = self.refresh()
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(requests[0].count("t3_"), 3)
+
+        for i, e in enumerate(content["entries"]):
+            self.assertEqual(e["reddit-json"], listing(i))
+            self.assertEqual(e["reddit-json-time"], 0)
+
+        # And again, once that's been written.
+
+        self.feed.update_contents = content
+        self.feed.index()
+
+        content, requests = self.refresh()
+        self.assertEqual(len(requests), 1)
+
+    def test_fresh(self):
+        old = { "canto_update" : time.time(), "entries" : [] }
+        for i in range(3):
+            e = entry(i)
+            e["reddit-json"] = listing(i)
+            e["reddit-json-time"] = time.time()
+            old["entries"].append(e)
+
+        self.feed.update_contents = old
+        self.feed.index()
+
+        content, requests = self.refresh()
+        self.assertEqual(requests, [])
+
+if __name__ == "__main__":
+    unittest.main()